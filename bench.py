@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# bench.py: Time steps B thru F of lib.py on the cached chapters in files/.
+#
+# Run it by typing "python3 bench.py" at your terminal (no quotes). For each step it prints
+# how many MB of input per second it gets through (best of --repeat runs), on:
+#
+#   - "real":  the real chapters, ie the step's input files in files/ (eg files/*_b_pruned.html for fix_html),
+#   - "x10", "x100": one synthetic chapter, 10 (100) times as long as a real one, made by repeating
+#     the paragraphs of the longest chapter. These show whether a step slows down on bigger input.
+#
+# To only time some of the steps, or only some sizes, add eg "--stages fix_html,fix_tex --scales 1,10".
+# (html_to_tex runs pandoc, which is by far the slowest step, so the x100 size takes a while.)
+#
+# To check a change for slowdowns:
+#
+#   $ python3 bench.py --save-baseline    # before the change: saves the numbers in bench-baseline.json
+#   $ python3 bench.py                    # after: compares against bench-baseline.json
+#
+# If any step is more than --threshold (default 20%) slower than the baseline, it says so
+# and exits with status 1. The baseline depends on the machine, so it isn't checked in.
+#
+# To time how long the scripts take to start up instead (eg "doit list", which runs no steps), add "--startup".
+# For each of STARTUP, it prints how many ms python3 takes to start it (best of --repeat runs),
+# and the slowest imports, according to "python3 -X importtime". --save-baseline etc work the same way.
+
+from lib import url_for_chapter, chapter_count, STORYTEXT_DIV, prune_html, fix_html, html_to_tex, fix_tex, make_final_tex
+
+import argparse
+import compileall
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+CHAPTER_NUMS = range(1, chapter_count(open(url_for_chapter(1, cached=True)).read()) + 1)
+
+# Each step, and the files in files/ it takes as input.
+STAGES = { 'prune_html'    : (prune_html,     'a_orig.html')
+         , 'fix_html'      : (fix_html,       'b_pruned.html')
+         , 'html_to_tex'   : (html_to_tex,    'c_fix.html')
+         , 'fix_tex'       : (fix_tex,        'd_pandoc.tex')
+         , 'make_final_tex': (make_final_tex, 'e_good.tex')
+         }
+
+# Each entry point, and the arguments to python3 that start it (see --startup).
+STARTUP = { 'import lib'          : ['-c', 'import lib']
+          , 'doit list'           : ['-m', 'doit', 'list']
+          , 'build.py --help'     : ['build.py', '--help']
+          , 'build-batch.py --help': ['build-batch.py', '--help']
+          , 'import watch'        : ['-c', 'import watch']
+          }
+
+def chapter_files(suffix):
+    return [ f for f in sorted(os.listdir('files')) if f.endswith(suffix) and int(f[:2]) in CHAPTER_NUMS ]
+
+def scale_up(stage, text, n):
+    '''
+    A synthetic chapter n times as long as text (a chapter of the step's input).
+    For the HTML steps, the chapter keeps its one heading (and for prune_html, the rest of the web page),
+    with its paragraphs repeated n times, all still on one line (see prune_html).
+    For the TeX, the whole chapter is repeated, so there are n chapter headings, like a long book.
+    '''
+    if stage == 'prune_html':
+        start = text.index(STORYTEXT_DIV) + len(STORYTEXT_DIV)
+        end = text.index('\n</div>', start)
+    elif stage in ('fix_html', 'html_to_tex'):
+        start = text.index('</h1>') + len('</h1>')
+        end = text.rindex('\n</div>')
+    else:
+        return text*n
+    return text[:start] + text[start:end]*n + text[end:]
+
+def inputs(stage, scale):
+    'The inputs to time stage on: a list of chapters (for make_final_tex, a list of lists of chapters).'
+    texts = [ open(f'files/{f}').read() for f in chapter_files(STAGES[stage][1]) ]
+    if stage == 'make_final_tex':
+        return [ texts ] if scale == 1 else [ texts*scale ]
+    if scale == 1:
+        return texts
+    return [ scale_up(stage, max(texts, key=len), scale) ]
+
+def run_once(stage, xs, tmp):
+    with redirect_stdout(io.StringIO()): # the steps print a lot
+        t0 = time.perf_counter()
+        for x in xs:
+            if stage == 'make_final_tex':
+                make_final_tex(x, saveas=os.path.join(tmp, 'bench.tex'), strs_should_be_present=[])
+            else:
+                STAGES[stage][0](x)
+        return time.perf_counter() - t0
+
+def bench(stage, scale, repeat, tmp):
+    'MB of input per second, for the fastest of `repeat` runs.'
+    xs = inputs(stage, scale)
+    nbytes = sum( len(t.encode('utf-8')) for x in xs for t in (x if stage == 'make_final_tex' else [x]) )
+    best = min( run_once(stage, xs, tmp) for _ in range(repeat) )
+    return nbytes / 1e6 / best
+
+def startup(argv, repeat):
+    '''
+    How long python3 takes to run the given arguments, in ms (the fastest of `repeat` runs),
+    and its 3 slowest top-level imports (in ms), according to one more run with "python3 -X importtime".
+    '''
+    def run(*flags):
+        return subprocess.run([sys.executable, *flags, *argv], capture_output=True, text=True, check=True)
+    def once():
+        t0 = time.perf_counter()
+        run()
+        return time.perf_counter() - t0
+    best = min( once() for _ in range(repeat) )
+    # eg "import time:       414 |     151941 | doit"; the imports they do are indented under them.
+    imports = { m.group(2): int(m.group(1)) / 1000
+                for m in re.finditer(r'^import time:\s+\d+ \|\s+(\d+) \| (\S+)$', run('-X', 'importtime').stderr, re.M) }
+    return best * 1000, sorted(imports.items(), key=lambda kv: -kv[1])[:3]
+
+def bench_startup(args, baseline):
+    'Time each of STARTUP (see the top of this file), like bench_steps does the steps. Returns the results and regressions.'
+    # Without the .pyc files (eg if PYTHONDONTWRITEBYTECODE is set), we'd be timing compiling lib.py, etc.
+    compileall.compile_dir('.', maxlevels=0, quiet=1)
+    results = {}
+    regressions = []
+    print(f"{'entry point':<22} {'ms':>7} {'baseline':>9} {'change':>7}  slowest imports (ms)")
+    for entry, argv in STARTUP.items():
+        name = f'startup/{entry}'
+        ms, imports = startup(argv, args.repeat)
+        results[name] = ms
+        line = f'{entry:<22} {ms:>7.1f}'
+        if name in baseline:
+            change = ms / baseline[name] - 1
+            line += f' {baseline[name]:>9.1f} {change:>+7.0%}'
+            if change > args.threshold:
+                regressions.append(name)
+                line += '  SLOWER'
+        else:
+            line += ' '*17
+        line += '  ' + ', '.join( f'{m} {t:.0f}' for m, t in imports )
+        print(line, flush=True)
+    return results, regressions
+
+def bench_steps(args, stages, scales, baseline):
+    'Time each of stages at each of scales. Returns the results and regressions.'
+    names = { 1: 'real' }
+    results = {}
+    regressions = []
+    print(f"{'step':<16} {'size':>5} {'MB/s':>9} {'baseline':>9} {'change':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for stage in stages:
+            for scale in scales:
+                name = f'{stage}/{names.get(scale, f"x{scale}")}'
+                results[name] = mbps = bench(stage, scale, args.repeat, tmp)
+                line = f"{stage:<16} {names.get(scale, f'x{scale}'):>5} {mbps:>9.2f}"
+                if name in baseline:
+                    change = mbps / baseline[name] - 1
+                    line += f' {baseline[name]:>9.2f} {change:>+7.0%}'
+                    if change < -args.threshold:
+                        regressions.append(name)
+                        line += '  SLOWER'
+                print(line, flush=True)
+    return results, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the steps of lib.py on the chapters in files/.')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f'comma-separated steps to time (default: {",".join(STAGES)})')
+    parser.add_argument('--scales', default='1,10,100',
+                        help='comma-separated sizes: 1 means the real chapters, N a synthetic chapter N times as long (default: 1,10,100)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='time each step this many times, and keep the fastest (default: 5)')
+    parser.add_argument('--baseline', default='bench-baseline.json',
+                        help='file with the numbers to compare against (default: bench-baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the numbers as the new baseline, instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fail if a step is more than this fraction slower than the baseline (default: 0.2)')
+    parser.add_argument('--startup', action='store_true',
+                        help='time how long lib.py, dodo.py, etc take to start up, instead of the steps')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    for s in stages:
+        if s not in STAGES:
+            parser.error(f'unknown step {s!r}, expected one of {", ".join(STAGES)}')
+    scales = [ int(n) for n in args.scales.split(',') ]
+
+    baseline = {}
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        baseline = json.load(open(args.baseline))
+
+    if args.startup:
+        results, regressions = bench_startup(args, baseline)
+    else:
+        results, regressions = bench_steps(args, stages, scales, baseline)
+
+    if args.save_baseline:
+        old = json.load(open(args.baseline)) if os.path.isfile(args.baseline) else {}
+        json.dump({ **old, **results }, open(args.baseline, 'w'), indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+    elif not baseline:
+        print(f'No baseline in {args.baseline} to compare against; make one with --save-baseline.')
+
+    if regressions:
+        print(f'{len(regressions)} slower than the baseline by more than {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
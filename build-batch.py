@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# build-batch.py: Typeset many stories from fanfiction.net at once, eg, overnight.
+#
+# Run it by typing "python3 build-batch.py stories.json --jobs 8" at your terminal (no quotes),
+# where stories.json lists the stories, eg:
+#
+#   [ {"story": 10360716, "dir": "books/10360716", "slug": "The-Metropolitan-Man"}
+#   , {"story": 1234567,  "dir": "books/1234567", "header": "books/1234567/header.tex", "check": ["The End"]}
+#   ]
+#
+# Each story gets its own directory: its chapters go in <dir>/files/ (with the same names build.py uses),
+# and the typeset story is <dir>/book.tex and <dir>/book.pdf.
+# "header" is the TeX that goes before the chapters, with the story's title page. It's required,
+# except for The Metropolitan Man (10360716), whose header is header.tex.
+# Optional keys: "slug" (the title part of the URL), "footer" (default: footer.tex),
+# and "check", a list of strings that should be in book.tex (see lib.make_final_tex; default: none).
+#
+# How many chapters a story has is read off the chapter drop-down on its chapter 1
+# (see lib.chapter_count), which we download first (or use <dir>/files/01_a_orig.html if it's there).
+# With --download (or --standin), all the other chapters are downloaded too; otherwise they must already be
+# in <dir>/files/.
+#
+# Rather than running build.py once per story, every chapter of every story goes into one pool of
+# --jobs processes, so a story with a few chapters doesn't leave most of the machine idle.
+# As soon as all of a story's chapters are done, the story is typeset, in that same pool.
+# --trace, --profile, and --pack work like they do in build.py; with --pack, each story's intermediate files
+# go in one archive, <dir>/files/chapters.pack, rather than dozens of files.
+# Before typesetting a story, its chapters' TeX is checked for likely problems (see lib.lint_tex),
+# and if there are errors, the story fails (to typeset it anyway, add --no-lint). If a story fails, the others carry on; the failures are listed at the end.
+# Like build.py, each story's manifest goes in <dir>/book.manifest.json (see lib.book_manifest), and a story
+# whose book.tex is the same as when its book.pdf was typeset isn't typeset again.
+
+from lib import build_chapter, trace_summary, url_for_chapter, chapter_count, download_many, serve_cached_chapters, make_final_tex, book_manifest, typeset_if_changed, chapter_bytes, pack_read, lint_chapters, lint_report, lint_errors
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+MM_STORY = 10360716 # the only story header.tex (with its title page) is for
+
+def story_header(story):
+    return story.get('header', 'header.tex' if story['story'] == MM_STORY else None)
+
+def chapter_files(story):
+    return f"{story['dir']}/files"
+
+def chapter_pack(story):
+    return f'{chapter_files(story)}/chapters.pack'
+
+def typeset_story(story, chapter_nums, pack=False, lint=True):
+    # Top-level function (not a lambda) so the process pool can pickle it.
+    files_dir = chapter_files(story)
+    if lint:
+        results = lint_chapters( ( pack_read(chapter_pack(story), f'{i:02}_e_good.tex') if pack else open(f'{files_dir}/{i:02}_e_good.tex').read()
+                                   for i in chapter_nums )
+                               , [f'{i:02}_e_good.tex' for i in chapter_nums] )
+        if any(results.values()):
+            print(f"{story['story']}:\n{lint_report(results)}")
+        if lint_errors(results):
+            raise RuntimeError(f'lint_tex found {lint_errors(results)} errors in the TeX, see above (to typeset anyway, add --no-lint)')
+    make_final_tex( ( pack_read(chapter_pack(story), f'{i:02}_e_good.tex') if pack else chapter_bytes(f'{files_dir}/{i:02}_e_good.tex')
+                      for i in chapter_nums )
+                  , saveas=f"{story['dir']}/book.tex"
+                  , strs_should_be_present=story.get('check', [])
+                  , header=story_header(story)
+                  , footer=story.get('footer', 'footer.tex')
+                  )
+    manifest = book_manifest(chapter_nums, f"{story['dir']}/book.tex", files_dir, pack=chapter_pack(story) if pack else None)
+    typeset_if_changed( f"{story['dir']}/book.tex", saveas=f"{story['dir']}/book.pdf", manifest=manifest
+                      , chapters=[f'{files_dir}/{i:02}_e_good.tex' for i in chapter_nums] )
+
+def download_chapters(stories, chapters, host, args, failed):
+    # Downloads the given chapters ({story id: [chapter numbers]}), returning their HTML.
+    # All the stories share one download_many, so its per-host rate limit covers all of them.
+    # A story with a chapter that couldn't be downloaded goes in failed ({story id: error}); the others carry on.
+    todo = [(story, i) for story in stories for i in chapters[story['story']]]
+    def on_error(j, e):
+        story, i = todo[j]
+        print(f"{story['story']}: downloading chapter {i} failed: {e!r}")
+        failed.setdefault(story['story'], e)
+    htmls = download_many( [url_for_chapter(i, host=host, story=story['story'], slug=story.get('slug', '')) for story, i in todo]
+                         , saveas=[f'{chapter_files(story)}/{i:02}_a_orig.html' for story, i in todo]
+                         , session='urllib' if args.standin else 'selenium'
+                         , workers=args.browsers
+                         , interval=0.1 if args.standin else 5.0
+                         , on_error=on_error
+                         )
+    return dict(zip([(story['story'], i) for story, i in todo], htmls))
+
+def main():
+    parser = argparse.ArgumentParser(description='Download and typeset many stories from fanfiction.net.')
+    parser.add_argument('manifest',
+                        help='JSON file listing the stories to typeset (see the top of build-batch.py)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of chapters to process concurrently (default: number of CPUs)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='always re-run steps B thru E, even if their input is unchanged')
+    parser.add_argument('--download', action='store_true',
+                        help='(re-)download the chapters from fanfiction.net first')
+    parser.add_argument('--standin', action='store_true',
+                        help='(re-)download the chapters from a local stand-in for fanfiction.net first (see --standin-files)')
+    parser.add_argument('--standin-files', default='books/{story}/files',
+                        help='where the stand-in finds the chapters it serves (default: books/{story}/files)')
+    parser.add_argument('--browsers', type=int, default=2,
+                        help='number of browsers to download with (default: 2)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='save how long each step took on each chapter, etc, to FILE (JSON lines), and print a summary')
+    parser.add_argument('--profile', metavar='STEP',
+                        help='run STEP (eg fix_html) under cProfile, saving a .prof file per chapter')
+    parser.add_argument('--pack', action='store_true',
+                        help="save each story's intermediate files in one archive, <dir>/files/chapters.pack")
+    parser.add_argument('--no-lint', dest='lint', action='store_false',
+                        help="typeset a story even if lib.lint_tex finds errors in its chapters' TeX")
+    args = parser.parse_args()
+
+    if args.trace:
+        open(args.trace, 'w').close()
+        os.environ['MM_TRACE'] = args.trace
+    if args.profile:
+        os.environ['MM_PROFILE'] = args.profile
+
+    stories = json.load(open(args.manifest))
+    no_header = [ str(story['story']) for story in stories if not story_header(story) ]
+    if no_header:
+        parser.error(f'no "header" in {args.manifest} for: {", ".join(no_header)} (header.tex is only for The Metropolitan Man, {MM_STORY})')
+    for story in stories:
+        os.makedirs(chapter_files(story), exist_ok=True)
+
+    failed = {} # story id -> the first error it hit
+    server = serve_cached_chapters(files_dir=args.standin_files) if args.standin else None
+    host = server.host if server else 'https://www.fanfiction.net'
+    try:
+        # Chapter 1 of each story tells us how many chapters it has.
+        need_first = [story for story in stories
+                      if args.download or args.standin or not os.path.isfile(f'{chapter_files(story)}/01_a_orig.html')]
+        firsts = download_chapters(need_first, {story['story']: [1] for story in need_first}, host, args, failed)
+        chapter_nums = {}
+        for story in stories:
+            if story['story'] in failed:
+                continue
+            try:
+                html = firsts.get((story['story'], 1)) or open(f'{chapter_files(story)}/01_a_orig.html').read()
+                chapter_nums[story['story']] = range(1, chapter_count(html) + 1)
+            except Exception as e:
+                print(f"{story['story']}: reading chapter 1 failed: {e!r}")
+                failed[story['story']] = e
+                continue
+            print(f"{story['story']}: {len(chapter_nums[story['story']])} chapters")
+
+        if args.download or args.standin:
+            download_chapters( [story for story in stories if story['story'] not in failed]
+                             , {story['story']: chapter_nums[story['story']][1:] for story in stories if story['story'] not in failed}
+                             , host, args, failed )
+    finally:
+        if server: server.shutdown()
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+        remaining = {}  # story id -> number of its chapters not done yet
+        pending = {}    # future -> (story, chapter number, or None for typesetting)
+        for story in stories:
+            if story['story'] in failed:
+                continue
+            remaining[story['story']] = len(chapter_nums[story['story']])
+            chapter = partial(build_chapter, cache=args.cache, files_dir=chapter_files(story), pack=chapter_pack(story) if args.pack else None)
+            for i in chapter_nums[story['story']]:
+                pending[ex.submit(chapter, i)] = (story, i)
+
+        while pending:
+            for fut in as_completed(list(pending)):
+                story, i = pending.pop(fut)
+                sid = story['story']
+                try:
+                    fut.result()
+                except Exception as e:
+                    print(f'{sid}: ' + (f'chapter {i}' if i else 'typesetting') + f' failed: {e!r}')
+                    failed.setdefault(sid, e)
+                    continue
+                if i is None:
+                    print(f"{sid}: done, see {story['dir']}/book.pdf")
+                    continue
+                remaining[sid] -= 1
+                if remaining[sid] == 0 and sid not in failed:
+                    pending[ex.submit(typeset_story, story, chapter_nums[sid], args.pack, args.lint)] = (story, None)
+                    break # as_completed() doesn't know about the new future, so start over
+
+    if args.trace:
+        print(trace_summary(args.trace))
+
+    if failed:
+        print(f'{len(failed)} of {len(stories)} stories failed: ' + ', '.join(str(sid) for sid in failed))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
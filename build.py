@@ -3,8 +3,44 @@
 # build.py: Download The Metropolitan Man from fanfiction.net and typeset it to PDF. 
 #
 # Run it by typing "python3 build.py" at your terminal (no quotes).
+# To process several chapters at once, type "python3 build.py --jobs 4".
+# To convert all the chapters to TeX with one pandoc run, add "--pandoc-batch".
+# To quickly typeset only the chapters that changed into mm-draft.pdf, add "--draft" (see lib.tex_to_pdf_draft).
+#
+# To re-download the chapters from fanfiction.net first, add "--download" (see lib.download_many).
+# To try that out without touching fanfiction.net, add "--standin", which downloads them over plain HTTP
+# from a local stand-in server that serves the cached files/*_a_orig.html.
+#
+# To overlap everything -- downloading, the Python steps, pandoc, and writing the files -- add "--async":
+# eg while pandoc converts chapter 3, chapter 4 goes through fix_html and chapter 2's files are written.
+# Set how many of each go on at once with --browsers (downloads), --jobs (the Python steps, in a
+# pool of processes), --pandoc-jobs, and --write-jobs. See build_async and lib.run_pipeline.
+#
+# Before typesetting, it checks the chapters' TeX for likely problems, like unbalanced braces (see lib.lint_tex),
+# which takes milliseconds rather than a failed pdflatex run. If it finds errors, it stops; to typeset anyway, add "--no-lint".
+#
+# To see how long each step took on each chapter, add "--trace trace.jsonl": that saves the details
+# in trace.jsonl, and prints a table at the end. To profile one of the steps, eg fix_html, add
+# "--profile fix_html", which saves a cProfile file (.prof) for each chapter. See lib.trace_span.
+#
+# Steps B thru E keep their outputs in a cache (.cache/stages/), keyed by a hash of their input,
+# code, and rules, so a step whose input hasn't changed is skipped. To turn that off, add "--no-cache".
 #
 # It creates several intermediate files in files/ with names like 3_a_orig.html.
+# To keep them all in one archive, files/chapters.pack, instead, add "--pack" (see lib.packed): then a step
+# whose input and code haven't changed since it was saved in the archive is skipped, like with the cache.
+# To skip writing them, and just pass each chapter from step to step in memory, add "--in-memory"
+# (or eg "--keep e" to write only the *_e_good.tex files). To write them in a background thread
+# while the next steps run, rather than waiting for each one, add "--background-writes".
+#
+# Each build saves a hash of every chapter at every step, and of mm.tex, in mm.manifest.json (see lib.book_manifest).
+# If mm.tex comes out the same as when mm.pdf was typeset, pdflatex isn't run again (see lib.typeset_if_changed).
+# To check that a change to lib.py (eg to fix_html) changes only what you meant it to, save a "golden" manifest
+# before the change with "--golden golden.json", and after the change run the same command again: it says which
+# chapters changed, and at which step, and fails if any did.
+#
+# To also size the cover art in cover-art/ for printing, screens, and e-readers, add "--covers": that saves
+# eg assets/print/MM_front.png and assets/print/whole-cover.png (see lib.prepare_covers).
 #
 # Note: The cached HTML files *_a_orig.html, *_b_pruned.html, and *_c_fix.html are all 1 long line,
 # needed to prevent incorrect spaces being added when parsed by pandoc and tex.
@@ -15,24 +51,236 @@
 # Also, since I started this project, fanfiction.net now seems to have bot-detection logic,
 # so this downloading logic no longer works: instead of retreiving the correct HTML, it gets a captcha-type webpage.
 # To get the real HTML, I believe you'd have to tell the requests.get function to fake certain headers.
+#
+# Note: the chapters don't depend on each other until make_final_tex, so with --jobs N
+# they're run in a pool of N processes. Executor.map() hands back the results in
+# chapter order, so mm.tex comes out the same regardless of which chapter finishes first.
+
+from lib import trace_summary, rule_report, lint_chapters, lint_report, lint_errors, background_writes, flush_writes, write_atomically, pack_write, stage_version, text_hash, unpack, run_pipeline, url_for_chapter, chapter_count, download, download_many, serve_cached_chapters, build_chapter, html_to_tex, html_to_tex_async, html_to_tex_batch, make_final_tex, tex_to_pdf_draft, book_manifest, manifest_diff, typeset_if_changed, prepare_covers, cached_async, cached_batch
+
+import argparse
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+
+# Chapters 1 thru however many the chapter drop-down on (our copy of) chapter 1 lists.
+CHAPTER_NUMS = range(1, chapter_count(open(url_for_chapter(1, cached=True)).read()) + 1)
+
+def check_tex(texs, m=map):
+    # Lint the chapters (see lib.lint_tex), with m (eg a process pool's map), printing any problems,
+    # and stop if there are errors, rather than waiting for pdflatex to fail.
+    results = lint_chapters(texs, [f'{i:02}_e_good.tex' for i in CHAPTER_NUMS], m)
+    if any(results.values()):
+        print(lint_report(results))
+    if lint_errors(results):
+        sys.exit('build.py: not typesetting, because of the errors above. To typeset anyway, add --no-lint.')
+
+def build_sync(args):
+    # Steps A thru E of every chapter, one chapter at a time (or args.jobs at once). Returns the chapters' TeX, in order.
+    chapter = partial(build_chapter, cache=args.cache, keep=args.keep, background=args.background_writes, pack=args.pack)
+    with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+        m = ex.map if args.jobs > 1 else map
+        if args.pandoc_batch:
+            htmls = list(m(chapter, CHAPTER_NUMS, repeat(0), repeat(3)))
+            saveas = [f'files/{i:02}_d_pandoc.tex' if 'd' in args.keep and not args.pack else None for i in CHAPTER_NUMS]
+            if args.cache:
+                texs = cached_batch(html_to_tex, html_to_tex_batch, htmls, saveas=saveas)
+            else:
+                texs = html_to_tex_batch(htmls, saveas=saveas)
+            if args.pack:
+                for i, html, tex in zip(CHAPTER_NUMS, htmls, texs):
+                    pack_write(args.pack, f'{i:02}_d_pandoc.tex', tex, version=stage_version(html_to_tex), input=text_hash(html))
+            texs = list(m(chapter, CHAPTER_NUMS, repeat(4), repeat(5), texs))
+        else:
+            texs = list(m(chapter, CHAPTER_NUMS))
+        if args.lint:
+            check_tex(texs, m)
+    return texs
+
+async def build_async(args, host=None):
+    # Steps A thru E of every chapter, overlapped with asyncio (see lib.run_pipeline). Returns the chapters' TeX, in order.
+    # host: where to download the chapters from (see lib.url_for_chapter), or None to use the cached files/*_a_orig.html.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    stopped = threading.Event() # tells download_many's threads to stop handing us chapters
+    write_slots = asyncio.Semaphore(args.write_jobs)
+    writing = set()
+
+    async def write(i, step, name, text):
+        # Start writing the file in a thread, and carry on, unless args.write_jobs writes are under way already.
+        if step not in args.keep: return
+        await write_slots.acquire()
+        t = asyncio.ensure_future(asyncio.to_thread(write_atomically, f'files/{i:02}_{step}_{name}', text))
+        t.add_done_callback(lambda _: write_slots.release())
+        writing.add(t)
+
+    async def feed(put):
+        if host is None:
+            for i in CHAPTER_NUMS:
+                await put(i, await asyncio.to_thread(download, url_for_chapter(i, cached=True)))
+            return
+        def arrived(j, html): # in one of download_many's threads
+            if stopped.is_set():
+                raise RuntimeError('build.py: stopped')
+            # The same text the other steps get from reading the file back (see lib.chapter_text), ie with universal newlines.
+            html = html.replace('\r\n', '\n').replace('\r', '\n')
+            asyncio.run_coroutine_threadsafe(put(CHAPTER_NUMS[j], html), loop).result()
+        await asyncio.to_thread( download_many
+                               , [url_for_chapter(i, host=host) for i in CHAPTER_NUMS]
+                               , saveas=[f'files/{i:02}_a_orig.html' for i in CHAPTER_NUMS]
+                               , session='urllib' if args.standin else 'selenium'
+                               , workers=args.browsers
+                               , interval=0.1 if args.standin else 5.0
+                               , on_done=arrived
+                               )
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        def step(i, n, x):
+            # Step lib.funcs_for_chapter(i)[n], in the process pool.
+            return loop.run_in_executor(pool, partial(build_chapter, i, n, n+1, x, cache=args.cache, keep=''))
+
+        async def html_steps(i, a):
+            b = await step(i, 1, a)
+            await write(i, 'b', 'pruned.html', b)
+            c = await step(i, 2, b)
+            await write(i, 'c', 'fix.html', c)
+            return c
+
+        async def pandoc(i, c):
+            d = await (cached_async(html_to_tex, html_to_tex_async, c) if args.cache else html_to_tex_async(c))
+            await write(i, 'd', 'pandoc.tex', d)
+            return d
+
+        async def tex_steps(i, d):
+            e = await step(i, 4, d)
+            await write(i, 'e', 'good.tex', e)
+            return e
+
+        try:
+            texs = await run_pipeline( feed
+                                     , [ ('html',   html_steps, args.jobs)
+                                       , ('pandoc', pandoc,     args.pandoc_jobs)
+                                       , ('tex',    tex_steps,  args.jobs)
+                                       ]
+                                     )
+        finally:
+            stopped.set()
+            await asyncio.gather(*writing)
+        texs = [ texs[i] for i in CHAPTER_NUMS ]
+        if args.lint:
+            check_tex(texs, pool.map if args.jobs > 1 else map)
+    return texs
+
+def main():
+    parser = argparse.ArgumentParser(description='Download and typeset The Metropolitan Man.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of chapters to process concurrently (default: 1)')
+    parser.add_argument('--pandoc-batch', action='store_true',
+                        help='convert all chapters to TeX with a single pandoc run')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='always re-run steps B thru E, even if their input is unchanged')
+    parser.add_argument('--draft', action='store_true',
+                        help='typeset only the chapters that changed, into mm-draft.pdf')
+    parser.add_argument('--download', action='store_true',
+                        help='re-download the chapters from fanfiction.net first')
+    parser.add_argument('--standin', action='store_true',
+                        help='re-download the chapters from a local stand-in for fanfiction.net first')
+    parser.add_argument('--browsers', type=int, default=2,
+                        help='number of browsers to download with (default: 2)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='save how long each step took on each chapter, etc, to FILE (JSON lines), and print a summary')
+    parser.add_argument('--profile', metavar='STEP',
+                        help='run STEP (eg fix_html) under cProfile, saving a .prof file per chapter')
+    parser.add_argument('--rule-report', action='store_true',
+                        help='at the end, show which chapters each fix_html / fix_tex rule changed, and which rules are dead')
+    parser.add_argument('--in-memory', dest='keep', action='store_const', const='', default='abcde',
+                        help="don't write the intermediate files in files/ (same as --keep '')")
+    parser.add_argument('--keep', default='abcde',
+                        help='which steps to save the intermediate files of, eg "de" (default: abcde)')
+    parser.add_argument('--background-writes', action='store_true',
+                        help='write the intermediate files in a background thread, without waiting for them')
+    parser.add_argument('--no-lint', dest='lint', action='store_false',
+                        help="typeset even if lib.lint_tex finds errors in the chapters' TeX")
+    parser.add_argument('--pack', nargs='?', const='files/chapters.pack', metavar='FILE',
+                        help='save the intermediate files in one archive, FILE (default: files/chapters.pack), rather than in files/')
+    parser.add_argument('--async', dest='use_asyncio', action='store_true',
+                        help='overlap the downloads, steps, pandoc runs, and file writes of all the chapters')
+    parser.add_argument('--pandoc-jobs', type=int, default=os.cpu_count(),
+                        help='with --async, number of pandocs to run at once (default: number of CPUs)')
+    parser.add_argument('--write-jobs', type=int, default=4,
+                        help='with --async, number of files to write at once (default: 4)')
+    parser.add_argument('--golden', metavar='FILE',
+                        help='compare every chapter at every step with the manifest in FILE, and fail if any changed (if there is no FILE, save it)')
+    parser.add_argument('--covers', action='store_true',
+                        help='also size the cover art for printing, screens, and e-readers, into assets/')
+    args = parser.parse_args()
+    if args.use_asyncio and args.pandoc_batch:
+        parser.error('--async and --pandoc-batch don\'t go together')
+    if args.use_asyncio and args.pack:
+        parser.error('--async and --pack don\'t go together')
+    if args.draft:
+        args.keep += 'e' # the draft is typeset from the *_e_good.tex files
+    if args.background_writes:
+        background_writes() # for the *_d_pandoc.tex files, with --pandoc-batch
+
+    # Environment variables, so the worker processes see them too.
+    if args.trace:
+        open(args.trace, 'w').close()
+        os.environ['MM_TRACE'] = args.trace
+    if args.profile:
+        os.environ['MM_PROFILE'] = args.profile
+
+    server = serve_cached_chapters() if args.standin else None
+    host = server.host if server else 'https://www.fanfiction.net' if args.download else None
+    if args.use_asyncio:
+        import asyncio # only here, since it's slow to import (see bench.py --startup)
+        try:
+            texs = asyncio.run(build_async(args, host))
+        finally:
+            if server: server.shutdown()
+    else:
+        if host:
+            download_many( [url_for_chapter(i, host=host) for i in CHAPTER_NUMS]
+                         , saveas=[f'files/{i:02}_a_orig.html' for i in CHAPTER_NUMS]
+                         , session='urllib' if server else 'selenium'
+                         , workers=args.browsers
+                         , interval=0.1 if server else 5.0
+                         )
+        if server: server.shutdown()
+        texs = build_sync(args)
+
+    flush_writes()
+    steps = 'abcde' if args.pack else args.keep # the steps whose outputs we have, to hash
+    if args.draft and args.pack:
+        tex_to_pdf_draft(unpack(args.pack, [f'{i:02}_e_good.tex' for i in CHAPTER_NUMS]), saveas='mm-draft.pdf')
+        manifest = book_manifest(CHAPTER_NUMS, tex_file=None, pack=args.pack)
+    elif args.draft:
+        tex_to_pdf_draft([f'files/{i:02}_e_good.tex' for i in CHAPTER_NUMS], saveas='mm-draft.pdf')
+        manifest = book_manifest(CHAPTER_NUMS, tex_file=None, steps=steps)
+    else:
+        make_final_tex( texs, saveas='mm.tex')
+        manifest = book_manifest(CHAPTER_NUMS, 'mm.tex', pack=args.pack, steps=steps)
+        typeset_if_changed('mm.tex', saveas='mm.pdf', manifest=manifest, chapters=[f'files/{i:02}_e_good.tex' for i in CHAPTER_NUMS])
+
+    if args.covers:
+        prepare_covers()
+
+    if args.trace:
+        print(trace_summary(args.trace))
+    if args.rule_report:
+        print(rule_report(pack=args.pack))
+    if args.golden and not os.path.isfile(args.golden):
+        write_atomically(args.golden, json.dumps(manifest, indent=1))
+        print(f'Saved the manifest to {args.golden}; next time, the build is compared against it.')
+    elif args.golden:
+        diff = manifest_diff(json.load(open(args.golden)), manifest)
+        print('\n'.join(diff) or f'The book is the same as in {args.golden}.')
+        if diff:
+            sys.exit(1)
 
-from lib import url_for_chapter, download, prune_html, fix_html, html_to_tex, fix_tex, make_final_tex, tex_to_pdf
-
-from functools import reduce 
-
-def funcs_for_chapter(i):
-    return [ lambda x: download(    x, saveas=f'files/{i:02}_a_orig.html' )
-           , lambda x: prune_html(  x, saveas=f'files/{i:02}_b_pruned.html' )
-           , lambda x: fix_html(    x, saveas=f'files/{i:02}_c_fix.html' )
-           , lambda x: html_to_tex( x, saveas=f'files/{i:02}_d_pandoc.tex' )
-           , lambda x: fix_tex(     x, saveas=f'files/{i:02}_e_good.tex' )
-           ]
-texs = [
-        reduce( lambda x,f: f(x)
-              , funcs_for_chapter(i)
-              , url_for_chapter(i, cached=True)
-              )
-        for i in range(1,14)
-        ]
-make_final_tex( texs, saveas='mm.tex')
-tex_to_pdf('mm.tex', saveas='mm.pdf')
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,34 @@ Usage:
 
     Run all tasks that need to be run:   $ doit
 
+    Convert all chapters to TeX with a single pandoc run:   $ doit pandoc_batch=1
+
+    Don't reuse cached outputs of steps B thru E (see lib.cached):   $ doit cache=0
+
+    Typeset only the chapters that changed, into mm-draft.pdf:   $ doit draft_pdf
+
+    Before typesetting, each chapter's TeX is checked for likely problems (see lib.lint_tex); to just do that:   $ doit lint_tex
+
+    pdflatex starts from a precompiled format of header.tex's preamble (see lib.preamble_format); to just make that:   $ doit preamble_fmt
+
+    Each build saves a hash of every chapter at every step in mm.manifest.json (see lib.book_manifest),
+    and only re-runs pdflatex if mm.tex changed. To compare with a manifest saved before a change:   $ python3 build.py --golden golden.json
+
+    Size the cover art for printing, screens, and e-readers, into assets/ (see lib.prepare_covers):   $ doit h_covers
+
+    Show which chapters each fix_html / fix_tex rule changes, and which rules are dead:   $ doit rule_report
+
+    Keep the intermediate files in one archive, files/chapters.pack, rather than in files/ (see lib.packed):   $ doit pack=1
+    A step is then re-run when its entry in the archive was made by an older version of the step,
+    or from a different input, which the archive's index records.
+
+    doit runs up to one task per CPU at once. To change that:   $ doit -n 4    (or doit -n 1, one at a time)
+    To also run at most 2 pandocs (and 1 pdflatex) at once:   $ doit pandoc_jobs=2 pdflatex_jobs=1
+
+    Save how long each step took on each chapter to trace.jsonl (see lib.trace_span),
+    and run fix_html under cProfile:   $ doit trace=trace.jsonl profile=fix_html
+    Then see the totals with:   $ python3 -c 'import lib; print(lib.trace_summary("trace.jsonl"))'
+
 
 Notes:
 
@@ -32,10 +60,163 @@ Sep 13, 2021
 
 
 # from doit.tools import run_once
-
-from lib import url_for_chapter, download, prune_html, fix_html, html_to_tex, fix_tex, make_final_tex, tex_to_pdf
-
-CHAPTER_NUMS = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13]
+import os
+import time
+try:
+    import fcntl
+except ImportError: # Windows: then pandoc_jobs and pdflatex_jobs have no effect
+    fcntl = None
+from contextlib import contextmanager
+from doit import get_var
+
+from lib import url_for_chapter, chapter_count, download, prune_html, fix_html, html_to_tex, html_to_tex_batch, fix_tex, make_final_tex, preamble_format, tex_to_pdf_draft, book_manifest, typeset_if_changed, prepare_covers, COVER_PIECES, COVER_PROFILES, COVER_EXTS, cached, cached_batch, rule_report, lint_tex, lint_report, chapter_bytes, chapter_text, pack_index, pack_read, pack_write, pack_current, packed, unpack, stage_version, text_hash
+
+# Chapters 1 thru however many the chapter drop-down on (our copy of) chapter 1 lists.
+CHAPTER_NUMS = list(range(1, chapter_count(open(url_for_chapter(1, cached=True)).read()) + 1))
+
+NUM_CPUS = os.cpu_count() or 1
+
+# Plain "doit" builds the whole book, but not the draft.
+# The chapters are independent, so doit runs up to NUM_CPUS tasks at once ("doit -n 1" for one at a time).
+# Each task is a top-level function (not a lambda), so it can be sent to doit's worker processes.
+DOIT_CONFIG = { 'default_tasks': ['a_download', 'b_prune_html', 'c_fix_html', 'd_html_to_tex', 'e_fix_tex', 'lint_tex', 'f_make_final_tex', 'preamble_fmt', 'g_tex_to_pdf']
+              , 'num_process': NUM_CPUS
+              , 'par_type': 'process'
+              }
+
+CACHE = get_var('cache', '1') != '0'
+PACK = 'files/chapters.pack' if get_var('pack', '0') != '0' else None
+
+# However many tasks doit runs at once, run at most this many pandocs (pdflatexes) at a time:
+# each one needs a lot more memory than the Python steps.
+PANDOC_JOBS = int(get_var('pandoc_jobs', NUM_CPUS))
+PDFLATEX_JOBS = int(get_var('pdflatex_jobs', 1))
+LOCK_DIR = '.cache/locks'
+
+@contextmanager
+def slot(name, n):
+    'Wait for one of n slots called name, shared by all the processes (a semaphore made of n locked files).'
+    if not fcntl:
+        yield
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    while True:
+        for k in range(n):
+            f = open(f'{LOCK_DIR}/{name}.{k}', 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield
+            finally:
+                f.close() # releases the lock
+            return
+        time.sleep(0.05)
+
+if get_var('trace'):
+    os.environ['MM_TRACE'] = get_var('trace')
+if get_var('profile'):
+    os.environ['MM_PROFILE'] = get_var('profile')
+
+def run(stage, x, saveas):
+    'Run a lib step, reusing its cached output if its input is unchanged.'
+    return cached(stage, x, saveas=saveas) if CACHE else stage(x, saveas=saveas)
+
+def entry(f):
+    'The name of file f\'s entry in the archive, eg files/05_c_fix.html -> 05_c_fix.html.'
+    return os.path.basename(f)
+
+def run_step(stage, fin, fout):
+    'Run a lib step on file fin, saving to fout (or with pack=1, on their entries in the archive).'
+    if PACK:
+        packed(stage, pack_read(PACK, entry(fin)), PACK, entry(fout), run=lambda stage, x: run(stage, x, None), reuse=False)
+    else:
+        run(stage, chapter_text(fin), fout) # (returns nothing, so the output isn't sent back to doit)
+
+def run_download(url, fout):
+    if PACK:
+        packed(download, url, PACK, entry(fout), reuse=False)
+    else:
+        download(url, saveas=fout)
+
+def run_pandoc(fin, fout):
+    with slot('pandoc', PANDOC_JOBS):
+        run_step(html_to_tex, fin, fout)
+
+def run_pandoc_batch(fins, fouts):
+    htmls = [pack_read(PACK, entry(f)) if PACK else chapter_text(f) for f in fins]
+    saveas = None if PACK else fouts
+    with slot('pandoc', PANDOC_JOBS):
+        if CACHE:
+            texs = cached_batch(html_to_tex, html_to_tex_batch, htmls, saveas=saveas)
+        else:
+            texs = html_to_tex_batch(htmls, saveas=saveas)
+    if PACK:
+        for html, tex, f in zip(htmls, texs, fouts):
+            pack_write(PACK, entry(f), tex, version=stage_version(html_to_tex), input=text_hash(html))
+
+def run_lint(fin):
+    problems = lint_tex(pack_read(PACK, entry(fin)) if PACK else chapter_text(fin))
+    if problems:
+        print(lint_report({ entry(fin): problems }))
+    if any( level == 'error' for _, level, _ in problems ):
+        return False # fails the task, so the book isn't typeset
+    if PACK:
+        return { 'chapters': chapter_hashes([fin]) }
+
+def run_make_final_tex(fins, fout):
+    if PACK:
+        make_final_tex(texs=(pack_read(PACK, entry(f)) for f in fins), saveas=fout)
+        return { 'chapters': chapter_hashes(fins) } # for chapters_unchanged, next time
+    make_final_tex(texs=(chapter_bytes(f) for f in fins), saveas=fout)
+
+def run_pdflatex(typeset, *args, **kwargs):
+    with slot('pdflatex', PDFLATEX_JOBS):
+        typeset(*args, **kwargs)
+
+def run_typeset(fin, fout):
+    # Skips pdflatex if mm.tex is the same as when mm.pdf was typeset (see lib.typeset_if_changed),
+    # eg when a change to fix_html re-made mm.tex, but didn't change it.
+    with slot('pdflatex', PDFLATEX_JOBS):
+        typeset_if_changed( fin, fout, book_manifest(CHAPTER_NUMS, fin, pack=PACK)
+                          , chapters=[f'files/{i:02}_e_good.tex' for i in CHAPTER_NUMS] )
+
+def run_draft_pdf(fins, fout):
+    with slot('pdflatex', PDFLATEX_JOBS):
+        tex_to_pdf_draft(unpack(PACK, [entry(f) for f in fins]) if PACK else fins, saveas=fout)
+    if PACK:
+        return { 'chapters': chapter_hashes(fins) }
+
+def print_rule_report():
+    print(rule_report(pack=PACK))
+
+# With pack=1, the tasks' inputs and outputs are entries in the archive, not files, so rather than
+# file_dep and targets, they say which tasks make their inputs (task_dep), and are up to date if the
+# archive's index says their outputs were made by the current version of the step from the current input.
+
+def entry_exists(fout):
+    return entry(fout) in pack_index(PACK)
+
+def entry_current(stage, fin, fout):
+    'Whether the entry for fout was made by this version of stage, from the entry for fin as it is now.'
+    source = pack_index(PACK).get(entry(fin), {}).get('sha256')
+    return source is not None and pack_current(PACK, entry(fout), stage, source)
+
+def chapter_hashes(fins):
+    index = pack_index(PACK)
+    return [ index.get(entry(f), {}).get('sha256') for f in fins ]
+
+def chapters_unchanged(task, values, fins):
+    'Whether the entries for fins are the same as the last time the task ran (see run_make_final_tex).'
+    return values.get('chapters') == chapter_hashes(fins)
+
+def step_deps(stage, fins, fouts, after):
+    'The dependencies of a task that makes fouts from fins, which are made by the tasks after.'
+    if not PACK:
+        return { 'file_dep': fins, 'targets': fouts }
+    return { 'task_dep': after, 'uptodate': [ (entry_current, (stage, fin, fout)) for fin, fout in zip(fins, fouts) ] }
 
 def task_a_download():
     'Download chapters 1 thru 13, creating *_a_orig.html'
@@ -44,8 +225,9 @@ def task_a_download():
         fn = f'files/{i:02}_a_orig.html'
         yield {
               'name': i,
-              'targets': [fn],
-              'actions': [ (download, (url_for_chapter(i, cached=True),), {'saveas': fn}) ],
+              **( { 'file_dep': [fn], 'uptodate': [(entry_exists, (fn,))] } if PACK else
+                  { 'targets': [fn] } ),
+              'actions': [ (run_download, (url_for_chapter(i, cached=True), fn)) ],
               'clean': True
               # 'uptodate': [run_once]
         }
@@ -58,9 +240,8 @@ def task_b_prune_html():
         fout = f'files/{i:02}_b_pruned.html'
         yield {
             'name': i,
-            'file_dep': [fin],
-            'targets': [fout],
-            'actions': [(lambda fin,fout: prune_html(html=open(fin).read(),saveas=fout),(fin,fout))],
+            **step_deps(prune_html, [fin], [fout], [f'a_download:{i}']),
+            'actions': [(run_step, (prune_html, fin, fout))],
             'clean': True
         }
 
@@ -71,9 +252,8 @@ def task_c_fix_html():
         fout = f'files/{i:02}_c_fix.html'
         yield {
             'name': i,
-            'file_dep': [fin],
-            'targets': [fout],
-            'actions': [( lambda fin,fout: fix_html( html = open(fin).read(), saveas = fout ), (fin,fout) )],
+            **step_deps(fix_html, [fin], [fout], [f'b_prune_html:{i}']),
+            'actions': [(run_step, (fix_html, fin, fout))],
             'clean': True
         }
 
@@ -81,14 +261,25 @@ def task_c_fix_html():
 def task_d_html_to_tex():
     'Use pandoc to convert HTML to TeX: *_c_fix.html -> *_d_pandoc.tex'
 
+    if get_var('pandoc_batch', ''):
+        # One pandoc run for all chapters, rather than paying pandoc's startup time 13 times.
+        fins = [f'files/{i:02}_c_fix.html' for i in CHAPTER_NUMS]
+        fouts = [f'files/{i:02}_d_pandoc.tex' for i in CHAPTER_NUMS]
+        yield {
+            'name': 'batch',
+            **step_deps(html_to_tex, fins, fouts, ['c_fix_html']),
+            'actions': [(run_pandoc_batch, (fins, fouts))],
+            'clean': True
+        }
+        return
+
     for i in CHAPTER_NUMS:
         fin = f'files/{i:02}_c_fix.html'
         fout = f'files/{i:02}_d_pandoc.tex'
         yield {
             'name': i,
-            'file_dep': [fin],
-            'targets': [fout],
-            'actions': ['pandoc -f html+smart -t latex+smart --top-level-division=chapter --output %(targets)s %(dependencies)s'],
+            **step_deps(html_to_tex, [fin], [fout], [f'c_fix_html:{i}']),
+            'actions': [(run_pandoc, (fin, fout))],
             'clean': True
         }
 
@@ -100,12 +291,24 @@ def task_e_fix_tex():
         fout = f'files/{i:02}_e_good.tex'
         yield {
             'name': i,
-            'file_dep': [fin],
-            'targets': [fout],
-            'actions': [( lambda fin,fout: fix_tex( tex = open(fin).read(), saveas = fout ), (fin,fout) )],
+            **step_deps(fix_tex, [fin], [fout], ['d_html_to_tex:batch' if get_var('pandoc_batch', '') else f'd_html_to_tex:{i}']),
+            'actions': [(run_step, (fix_tex, fin, fout))],
             'clean': True
         }
 
+def task_lint_tex():
+    'Check the TeX of each chapter for likely problems (see lib.lint_tex), before typesetting it'
+
+    for i in CHAPTER_NUMS:
+        fin = f'files/{i:02}_e_good.tex'
+        yield {
+            'name': i,
+            **( { 'task_dep': [f'e_fix_tex:{i}'], 'uptodate': [(chapters_unchanged, ([fin],))] } if PACK else
+                { 'file_dep': [fin] } ),
+            'actions': [(run_lint, (fin,))],
+            'verbosity': 2,
+        }
+
 def task_f_make_final_tex():
     'Combine TeX files: *_e_good.tex -> mm.tex'
 
@@ -113,28 +316,75 @@ def task_f_make_final_tex():
     deps = ['header.tex'] + ch_deps + ['footer.tex']
     fout = 'mm.tex'
     return {
-        'file_dep': deps,
+        **( { 'file_dep': ['header.tex', 'footer.tex'], 'uptodate': [(chapters_unchanged, (ch_deps,))] }
+            if PACK else { 'file_dep': deps } ),
+        'task_dep': ['lint_tex'],
         'targets': [fout],
-        'actions': [( lambda fins, fout: make_final_tex(texs=[open(f).read() for f in ch_deps], saveas=fout), (ch_deps, fout) )],
+        'actions': [(run_make_final_tex, (ch_deps, fout))],
         'clean': True
     }
 
+def task_preamble_fmt():
+    'Precompile the preamble of header.tex into a pdflatex format, which pdflatex starts from (see lib.preamble_format)'
+    'Only re-made when header.tex or extdash.sty change; runs while the chapters are still being converted.'
+
+    return {
+        'file_dep': ['header.tex', 'extdash.sty'],
+        'actions': [(run_pdflatex, (preamble_format, 'header.tex'))],
+    }
+
 def task_g_tex_to_pdf():
     'Create final PDF: mm.tex -> mm.pdf'
-    'Run twice to create TOC.'
+    'Re-runs pdflatex until the TOC stops changing.'
 
     n = 'mm'
     tex = n+'.tex'
     pdf = n+'.pdf'
     return {
         'file_dep': [tex],
+        'task_dep': ['preamble_fmt'],
         'targets': [pdf],
-        'actions': 2*[f'pdflatex -interaction=batchmode {tex}'],
+        'actions': [(run_typeset, (tex, pdf))],
+        'clean': True
+    }
+
+def task_draft_pdf():
+    'Typeset only the changed chapters: *_e_good.tex -> mm-draft.pdf'
+
+    ch_deps = [f'files/{i:02}_e_good.tex' for i in CHAPTER_NUMS]
+    return {
+        **( { 'file_dep': ['header.tex', 'footer.tex'], 'uptodate': [(chapters_unchanged, (ch_deps,))] }
+            if PACK else { 'file_dep': ['header.tex'] + ch_deps + ['footer.tex'] } ),
+        'task_dep': ['lint_tex', 'preamble_fmt'],
+        'targets': ['mm-draft.pdf'],
+        'actions': [(run_draft_pdf, (ch_deps, 'mm-draft.pdf'))],
+        'clean': True
+    }
+
+def task_h_covers():
+    'Size the cover art for printing, screens, and e-readers: cover-art/*.png -> assets/*/'
+    'Not run by default, since mm.pdf doesn\'t need it; see lib.prepare_covers.'
+
+    return {
+        'file_dep': COVER_PIECES,
+        'targets': [ f'assets/{name}/whole-cover.{COVER_EXTS[p["format"]]}' for name, p in COVER_PROFILES.items() ],
+        'actions': [(prepare_covers, ())],
         'clean': True
     }
 
 # Convenience tasks for development:
 
+def task_rule_report():
+    'Show which chapters each rule of fix_html and fix_tex changes, and which rules are dead'
+
+    return {
+        **( { 'task_dep': ['b_prune_html', 'd_html_to_tex'] } if PACK else
+            { 'file_dep': [f'files/{i:02}_{s}' for i in CHAPTER_NUMS for s in ['b_pruned.html', 'd_pandoc.tex']] } ),
+        'actions': [print_rule_report],
+        'uptodate': [False],
+        'verbosity': 2,
+    }
+
 # def task_tmp_open_pdf():
 #     return {
 #         'file_dep': ['mm.pdf'],
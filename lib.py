@@ -1,20 +1,534 @@
 import re, os
-from bs4 import BeautifulSoup
 import subprocess
-from functools import reduce 
+from functools import reduce, lru_cache, wraps
+from contextlib import contextmanager
+from itertools import chain
+import hashlib, json
+import sys
+import threading, time
+import mmap
+import struct, zlib
+try:
+    import resource # not on Windows, where traces leave out memory use, and the CPU time of eg pandoc
+except ImportError:
+    resource = None
+try:
+    import fcntl # not on Windows, where chapter archives aren't locked (so use one process at a time)
+except ImportError:
+    fcntl = None
+import bisect, collections
+import shutil
+
+# The slow-to-import modules (bs4, html.parser, asyncio, inspect, urllib, http.server, concurrent.futures,
+# cProfile, selenium, PIL) are imported in the functions that use them, and the regexes are compiled the first
+# time they're used (see lazy_regex), so that eg "doit list", which doesn't run any steps, starts quickly.
+# To see how long importing lib etc takes, run "python3 bench.py --startup".
 
 # TODO: type annotations.
 
-def url_for_chapter(i, cached=False):
+class lazy_regex:
+    '''
+    Like re.compile(pattern, flags), but the pattern is only compiled the first time it's used,
+    eg LINT_TOKENS.finditer(tex). After that, its methods are looked up directly, with no extra cost.
+    '''
+    def __init__(self, pattern, flags=0):
+        self.pattern, self.flags = pattern, flags
+
+    def __getattr__(self, name): # only called for names we don't have yet
+        value = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, value)
+        return value
+
+
+# Instrumentation.
+#
+# Set the environment variable MM_TRACE to a file name (or use build.py --trace) and each step
+# appends a line of JSON to that file every time it runs: which chapter, how long it took
+# (wall and CPU time, including programs it ran, like pandoc), the peak memory use so far,
+# how many bytes went in and out, and for steps B thru E, whether it was a cache hit or miss.
+# Each pdflatex run and each download in download_many gets a line too.
+# trace_summary() turns the trace into a table.
+#
+# Set MM_PROFILE to the name of a step (eg fix_html, or build.py --profile fix_html) to run
+# that step under cProfile, saving one <step>-<chapter>.prof file per run next to the trace.
+# Look at them with "python3 -m pstats fix_html-05_c_fix.html.prof".
+#
+# They're environment variables, rather than globals, so the worker processes of build.py --jobs see them too.
+
+_trace = threading.local() # _trace.cache is 'miss' while cached() is running a stage
+
+def data_size(x):
+    'Size in bytes of a string, a file name, or a list of those. None if we cant tell (eg a generator).'
+    if isinstance(x, str):
+        try:
+            if len(x) < 4096 and os.path.isfile(x):
+                return os.path.getsize(x)
+        except ValueError: # eg, a NUL character in x
+            pass
+        return len(x.encode('utf-8'))
+    if isinstance(x, (list, tuple)):
+        sizes = [ data_size(y) for y in x ]
+        return None if None in sizes else sum(sizes)
+    return None
+
+def trace_label(x, saveas=None):
+    'Which chapter a step is working on: the name of the file it saves to, or else its input file or URL.'
+    if isinstance(saveas, str):
+        return os.path.basename(saveas)
+    if isinstance(x, str) and len(x) < 4096 and '\n' not in x:
+        return x
+    return None
+
+@contextmanager
+def trace_span(stage, label=None, **fields):
+    '''
+    Time the code in the with-block, and append a line about it to the MM_TRACE file (if set):
+        with trace_span('pdflatex', 'mm run #1') as span:
+            ...
+            span['bytes_out'] = 1234 # add whatever else you like
+    '''
+    trace = os.environ.get('MM_TRACE')
+    span = { 'stage': stage, 'label': label, **fields }
+    if os.environ.get('MM_PROFILE') == stage:
+        import cProfile
+        prof = cProfile.Profile()
+    else:
+        prof = None
+    t0, cpu0, kids0 = time.perf_counter(), time.process_time(), resource and resource.getrusage(resource.RUSAGE_CHILDREN)
+    if prof: prof.enable()
+    try:
+        yield span
+    except BaseException as e:
+        span['error'] = repr(e)
+        raise
+    finally:
+        if prof:
+            prof.disable()
+            name = re.sub(r'[^\w.-]', '_', f'{stage}-{label or os.getpid()}')
+            prof.dump_stats(os.path.join(os.path.dirname(trace or '') or '.', f'{name}.prof'))
+        span.update( start    = time.time() - (time.perf_counter() - t0)
+                   , wall     = time.perf_counter() - t0
+                   , cpu      = time.process_time() - cpu0
+                   , pid      = os.getpid()
+                   )
+        if resource:
+            kids1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            mb = 2**20 if sys.platform == 'darwin' else 2**10 # ru_maxrss is in bytes on macOS, KB on Linux
+            span['cpu'] += (kids1.ru_utime + kids1.ru_stime) - (kids0.ru_utime + kids0.ru_stime)
+            span.update( rss_mb       = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / mb
+                       , child_rss_mb = kids1.ru_maxrss / mb
+                       )
+        if trace:
+            with open(trace, 'a') as f: # one write per line, so lines from several processes don't get mixed up
+                f.write(json.dumps(span) + '\n')
+
+@lru_cache(maxsize=None)
+def stage_signature(stage):
+    import inspect
+    return inspect.signature(stage)
+
+def traced(stage):
+    '''
+    Decorator for the steps below: run the step in a trace_span (if MM_TRACE or MM_PROFILE is set),
+    recording the size of its input and output.
+    '''
+    @wraps(stage)
+    def traced_stage(*args, **kwargs):
+        if not (os.environ.get('MM_TRACE') or os.environ.get('MM_PROFILE')):
+            return stage(*args, **kwargs)
+        given = stage_signature(stage).bind(*args, **kwargs).arguments
+        x, saveas = next(iter(given.values())), given.get('saveas') # the input is the first argument
+        with trace_span( stage.__name__, trace_label(x, saveas)
+                       , bytes_in=data_size(x), cache=getattr(_trace, 'cache', None) ) as span:
+            out = stage(*args, **kwargs)
+            span['bytes_out'] = data_size(out if out is not None else saveas)
+        return out
+    return traced_stage
+
+def trace_summary(trace):
+    'A table of the spans in the trace file: for each step, how many runs, and their totals.'
+    rows = {}
+    for span in map(json.loads, open(trace)):
+        r = rows.setdefault(span['stage'], dict(runs=0, hits=0, errors=0, wall=0, cpu=0, rss=0, inp=0, out=0))
+        r['runs']   += 1
+        r['hits']   += span.get('cache') == 'hit'
+        r['errors'] += 'error' in span
+        r['wall']   += span['wall']
+        r['cpu']    += span['cpu']
+        r['rss']     = max(r['rss'], span.get('rss_mb', 0), span.get('child_rss_mb', 0))
+        r['inp']    += span.get('bytes_in') or 0
+        r['out']    += span.get('bytes_out') or 0
+    lines = [ f"{'step':<20} {'runs':>5} {'hits':>5} {'errors':>6} {'wall s':>8} {'cpu s':>8} {'peak MB':>8} {'in MB':>7} {'out MB':>7}" ]
+    for stage, r in sorted(rows.items(), key=lambda kv: -kv[1]['wall']):
+        lines.append( f"{stage:<20} {r['runs']:>5} {r['hits']:>5} {r['errors']:>6} {r['wall']:>8.2f} {r['cpu']:>8.2f}"
+                      f" {r['rss']:>8.1f} {r['inp']/1e6:>7.2f} {r['out']/1e6:>7.2f}" )
+    return '\n'.join(lines)
+
+# Saving each step's output.
+#
+# Every step saves its output (if given saveas) with save(). Normally that's a plain write
+# (to a temp file that then replaces the old one, so a process that has the old one mapped
+# with chapter_bytes doesn't see it change under its feet),
+# but after background_writes(), save() just hands the text to a background thread and returns,
+# so the next step can get going without waiting for the disk (eg, a slow network drive).
+# Call flush_writes() to wait until everything has been written, eg before reading the files back.
+
+_writer = None          # the background thread (a 1-thread executor), if any
+_writer_pid = None      # the process it belongs to: a forked child (eg build.py --jobs) doesn't have it
+_pending_writes = []    # its futures, one per write, until flush_writes()
+
+def save(path, text):
+    'Save a step\'s output to path, now, or in the background (see background_writes).'
+    if _writer is None or _writer_pid != os.getpid():
+        write_atomically(path, text)
+    else:
+        _pending_writes.append(_writer.submit(write_atomically, path, text))
+
+def background_writes():
+    'From now on (in this process), save() writes files in a background thread. See flush_writes.'
+    global _writer, _writer_pid, _pending_writes
+    if _writer is None or _writer_pid != os.getpid():
+        from concurrent.futures import ThreadPoolExecutor
+        _writer, _writer_pid, _pending_writes = ThreadPoolExecutor(max_workers=1), os.getpid(), []
+
+def flush_writes():
+    'Wait for the background writes to finish, raising the first error (eg disk full), if any.'
+    global _pending_writes
+    pending, _pending_writes = _pending_writes, []
+    for f in pending:
+        f.result()
+
+
+# Chapter store: reading files/*, header.tex, etc.
+#
+# chapter_bytes(path) memory-maps the file and returns a read-only memoryview of it, without copying
+# it into memory; chapter_text(path) decodes it into a str, once. Either way, each file is read
+# only once per process (eg by all the doit tasks that run in one worker process), and re-read
+# only when its size or mtime changes, or it's replaced by another file (a new inode; eg write_atomically
+# replaces the file, and the new one can have the same size and mtime, if it was written within the same clock tick).
+#
+# Each mapping holds a file descriptor open (mmap keeps a copy of it), and a process may only have a few
+# hundred (eg 256 on macOS), so at most CHAPTER_STORE_MAPS files stay mapped: the least recently used
+# mapping is dropped (and closed, once nothing else uses it) to make room. chapter_text keeps only the str,
+# so reading a file's text doesn't keep it mapped.
+#
+# The steps B thru E work on strs (HTMLParser and the rules need text, eg '…'), so they use chapter_text.
+# make_final_tex only copies the chapters and searches them, so it can use chapter_bytes directly.
+
+CHAPTER_STORE_MAPS = 64
+
+_store = {} # path -> [(device, inode, mtime_ns), size, memoryview or None, str or None]
+_mapped = collections.OrderedDict() # path -> its entry in _store, for those with a memoryview, least recently used first
+
+def _stored(path):
+    st = os.stat(path)
+    entry = _store.get(path)
+    key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+    if entry is None or entry[:2] != [key, st.st_size]:
+        entry = _store[path] = [key, st.st_size, None, None]
+    return entry
+
+def _map(path, size):
+    if size == 0: # can't mmap an empty file
+        return memoryview(b'')
+    with open(path, 'rb') as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def chapter_bytes(path):
+    'The contents of path, as a read-only memoryview of a memory-mapping of the file.'
+    entry = _stored(path)
+    if entry[2] is None:
+        entry[2] = _map(path, entry[1])
+    _mapped.pop(path, None)
+    _mapped[path] = entry
+    while len(_mapped) > CHAPTER_STORE_MAPS:
+        _, old = _mapped.popitem(last=False)
+        old[2] = None
+    return entry[2]
+
+def chapter_text(path):
+    'The contents of path, as a str, the same as open(path).read() (ie with universal newlines).'
+    entry = _stored(path)
+    if entry[3] is None:
+        text = str(entry[2] if entry[2] is not None else _map(path, entry[1]), 'utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        entry[3] = text
+    return entry[3]
+
+
+# Chapter archive: all the steps' outputs for a story in one file, eg files/chapters.pack.
+#
+# Rather than 5 files per chapter in files/ (65 for The Metropolitan Man, thousands for build-batch.py),
+# build.py --pack and "doit pack=1" keep them as entries of one archive, named like the files would be
+# (eg '05_c_fix.html'). Each entry is compressed (zlib) on its own, and the archive ends with an index
+# giving, for each entry, where it is (offset and length), its size, the sha256 of its contents,
+# the version of the step that made it (see stage_version), and the sha256 of that step's input.
+# So reading an entry only reads that entry, and whether a step is up to date (see pack_current)
+# can be told from the index alone, without reading any chapters.
+#
+# The layout is:
+#
+#     PACK_MAGIC
+#     entry, entry, ...      each zlib-compressed
+#     index                  zlib-compressed JSON: { name: {offset, length, size, sha256, version, input} }
+#     footer                 the offset and length of the index (8 bytes each, little-endian), then PACK_MAGIC
+#
+# Writing an entry appends it, then a new index and footer, so a reader only needs the last footer,
+# and a write that fails half-way is truncated away. Once old copies of entries (and old indexes)
+# take up more than half the file, it's re-written without them (see pack_compact).
+# Several processes (build.py --jobs, doit -n) can use one archive at once: writers lock it
+# (fcntl.flock) exclusively, readers shared.
+
+PACK_MAGIC = b'MMPACK1\n'
+PACK_FOOTER = struct.Struct('<QQ8s')
+
+_pack_indexes = {} # path -> (inode, size, mtime_ns, index), so the index is only re-read when the archive changes
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+@contextmanager
+def _locked_pack(pack, write=False):
+    # The archive, open and locked (for writing: exclusively, and created if need be).
+    while True:
+        f = open(os.open(pack, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') if write else open(pack, 'rb')
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        # If another process re-wrote the archive (pack_compact) while we waited, we have the old one: start over.
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(pack).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        yield f
+    finally:
+        f.close() # releases the lock
+
+def _read_index(pack, f):
+    st = os.fstat(f.fileno())
+    hit = _pack_indexes.get(pack)
+    if hit and hit[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+        return hit[3]
+    index = {}
+    if st.st_size > 0:
+        f.seek(st.st_size - PACK_FOOTER.size)
+        offset, length, magic = PACK_FOOTER.unpack(f.read(PACK_FOOTER.size))
+        if magic != PACK_MAGIC:
+            raise ValueError(f'{pack} is not a chapter archive, or is damaged')
+        f.seek(offset)
+        index = json.loads(zlib.decompress(f.read(length)))
+    _pack_indexes[pack] = (st.st_ino, st.st_size, st.st_mtime_ns, index)
+    return index
+
+def _write_index(f, index):
+    offset = f.tell()
+    raw = zlib.compress(json.dumps(index, sort_keys=True).encode('utf-8'))
+    f.write(raw)
+    f.write(PACK_FOOTER.pack(offset, len(raw), PACK_MAGIC))
+
+def pack_index(pack):
+    'The index of the archive: { entry name: {offset, length, size, sha256, version, input} }, or {} if there is no archive.'
+    if not os.path.exists(pack):
+        return {}
+    with _locked_pack(pack) as f:
+        return _read_index(pack, f)
+
+def pack_read(pack, name):
+    'The text of entry name of the archive. Raises KeyError if there is no such entry.'
+    with _locked_pack(pack) as f:
+        e = _read_index(pack, f)[name]
+        f.seek(e['offset'])
+        data = zlib.decompress(f.read(e['length']))
+    if hashlib.sha256(data).hexdigest() != e['sha256']:
+        raise ValueError(f'{pack}: entry {name} is damaged')
+    return data.decode('utf-8')
+
+def pack_write(pack, name, text, version=None, input=None):
+    '''
+    Save text as entry name of the archive (creating it if need be), made by version of a step
+    from input (a text_hash). Does nothing if the entry is already exactly that.
+    '''
+    data = text.encode('utf-8')
+    entry = { 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(), 'version': version, 'input': input }
+    with _locked_pack(pack, write=True) as f:
+        index = dict(_read_index(pack, f))
+        if all( index.get(name, {}).get(k) == v for k, v in entry.items() ):
+            return
+        end = os.fstat(f.fileno()).st_size
+        try:
+            f.seek(end)
+            if end == 0:
+                f.write(PACK_MAGIC)
+            blob = zlib.compress(data)
+            index[name] = { 'offset': f.tell(), 'length': len(blob), **entry }
+            f.write(blob)
+            _write_index(f, index)
+            f.flush()
+        except BaseException:
+            f.truncate(end)
+            raise
+        live = len(PACK_MAGIC) + sum( e['length'] for e in index.values() )
+        if f.tell() > 2*live + 65536:
+            _compact(pack, f, index)
+
+def _compact(pack, f, index):
+    # Copy just the current entries (still compressed) into a new archive, which replaces the old one.
+    tmp = f'{pack}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(PACK_MAGIC)
+        new = {}
+        for name, e in sorted(index.items(), key=lambda kv: kv[1]['offset']):
+            f.seek(e['offset'])
+            new[name] = { **e, 'offset': out.tell() }
+            out.write(f.read(e['length']))
+        _write_index(out, new)
+    os.replace(tmp, pack)
+
+def pack_compact(pack):
+    'Re-write the archive without the old copies of its entries.'
+    with _locked_pack(pack, write=True) as f:
+        _compact(pack, f, _read_index(pack, f))
+
+def pack_current(pack, name, stage, source):
+    '''
+    Whether entry name of the archive was made by the current version of stage (see stage_version),
+    from an input whose hash is source. Eg, to check 05_c_fix.html is up to date:
+        pack_current(pack, '05_c_fix.html', fix_html, pack_index(pack)['05_b_pruned.html']['sha256'])
+    '''
+    e = pack_index(pack).get(name)
+    return bool(e) and e['version'] == stage_version(stage) and e['input'] == source
+
+def packed(stage, x, pack, name, run=None, reuse=True):
+    '''
+    Like stage(x), but save the output as entry name of the archive, along with the
+    version of stage and the hash of x. If that entry is already up to date (see pack_current),
+    just read it back, rather than running stage. run(stage, x) runs the stage (default: stage(x)), eg through cached().
+    With reuse=False, always run stage, eg for download, whose input is just a URL.
+    '''
+    source = text_hash(x)
+    if reuse and pack_current(pack, name, stage, source):
+        with trace_span(stage.__name__, name, bytes_in=data_size(x), cache='hit') as span:
+            print(f'{stage.__name__}: {name} is up to date in {pack}')
+            out = pack_read(pack, name)
+            span['bytes_out'] = data_size(out)
+        return out
+    out = run(stage, x) if run else stage(x)
+    pack_write(pack, name, out, version=stage_version(stage), input=source)
+    return out
+
+def unpack(pack, names, files_dir='files'):
+    '''
+    Write the given entries of the archive out as files in files_dir (eg for tex_to_pdf_draft, which needs files),
+    leaving alone the ones that are already the same. Returns the files' names.
+    '''
+    paths = []
+    for name in names:
+        path = os.path.join(files_dir, name)
+        text = pack_read(pack, name)
+        if not os.path.isfile(path) or open(path, 'rb').read() != text.encode('utf-8'):
+            write_atomically(path, text)
+        paths.append(path)
+    return paths
+
+
+# Async pipeline: for build.py --async.
+#
+# run_pipeline passes items (eg chapters) through a list of stages, like reduce() does,
+# but each stage works on several items at once, and on different items than the other stages:
+# while pandoc converts chapter 3, chapter 4 can be in fix_html, chapter 5 downloading,
+# and chapter 2's files being written. Between each pair of stages is a queue of at most
+# queue_size items, so a fast stage (eg downloading from the stand-in) can't run far ahead
+# of a slow one (pandoc) and fill up memory.
+#
+# The stages are asyncio coroutines, so they should await anything slow: run_in_executor
+# for the Python steps (see build.py), and asyncio subprocesses for pandoc (see html_to_tex_async).
+
+async def run_pipeline(feed, stages, queue_size=4):
+    '''
+    Run items through stages, a list of (name, f, workers): f is an async function f(k, x)
+    that returns the next stage's input for item k, and `workers` items at once go through it.
+    feed is an async function that calls `await put(k, x)` for each item (the first stage's input).
+    Returns a dict from each k to its output from the last stage.
+    If anything fails, the rest is cancelled, and the first error is raised.
+    '''
+    import asyncio
+    queues = [ asyncio.Queue(queue_size) for _ in stages ]
+    outs = {}
+
+    async def put(k, x):
+        await queues[0].put((k, x))
+
+    async def worker(j, f):
+        while (item := await queues[j].get()) is not None:
+            k, x = item
+            y = await f(k, x)
+            if j+1 < len(stages):
+                await queues[j+1].put((k, y))
+            else:
+                outs[k] = y
+
+    async def finish(j):
+        # One None per worker of stage j, to tell them there's nothing more coming.
+        if j < len(stages):
+            for _ in range(stages[j][2]):
+                await queues[j].put(None)
+
+    async def run_feed():
+        await feed(put)
+        await finish(0)
+
+    async def run_stage(j, f, workers):
+        await asyncio.gather(*[ worker(j, f) for _ in range(workers) ])
+        await finish(j+1)
+
+    tasks = [ asyncio.ensure_future(run_feed())
+            , *[ asyncio.ensure_future(run_stage(j, f, workers)) for j, (name, f, workers) in enumerate(stages) ]
+            ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel() # only does anything if something failed
+    return outs
+
+
+def url_for_chapter(i, cached=False, host='https://www.fanfiction.net', story=10360716, slug='The-Metropolitan-Man', files_dir='files'):
+    '''
+    URL of chapter i of a story on fanfiction.net, or with cached=True, the local copy in files_dir.
+    The slug (the story's title) is optional: fanfiction.net finds the story without it.
+    '''
     if cached:
-        s = f'files/{i:02}_a_orig.html'
+        s = f'{files_dir}/{i:02}_a_orig.html'
         if not os.path.isfile(s):
             raise ValueError(f"You set cached={cached} but I can't find cached file '{s}' for chapter {i}!")
         return s
     else:
-        return f'https://www.fanfiction.net/s/10360716/{i}/The-Metropolitan-Man'
+        return f'{host}/s/{story}/{i}/{slug}'
 
+def chapter_count(html):
+    '''
+    How many chapters the story has, according to the "Chapter Navigation" drop-down
+    on the page of any of its chapters. One-chapter stories don't have the drop-down.
+    '''
+    select = re.search(r'<select id=chap_select[^>]*>(.*?)</select>', html, re.IGNORECASE | re.DOTALL)
+    if not select:
+        return 1
+    return max(int(v) for v in re.findall(r'<option\s+value=(\d+)', select.group(1), re.IGNORECASE))
+
+
+def verify_html(html):
+    assert type(html) == str, f'Expected html to have type str, not {type(html)}'
+    assert len(html) > 300
+    assert len(html.splitlines()) > 100
+    assert html.startswith('<!DOCTYPE html><html><head>')
+    assert html.endswith('</body></html>')
+    assert "<div class='storytext xcontrast_txt nocopy' id='storytext'>" in html
+    return html
 
+@traced
 def download(url, saveas=None):
     '''
     Step A: Download chapters 1 thru 13 of MM from fanfiction.net (or a local file),
@@ -23,21 +537,14 @@ def download(url, saveas=None):
     Warning: since I started this project, fanfiction.net now seems to have bot-detection logic,
     so this downloading logic does not retreive the correct HTML, but rather, a captcha-type webpage.
     So we use an automated browser (Selenium Webdriver) rather than curl or the 'requests' module.
-    '''
 
-    def verify_html(html):
-        assert type(html) == str, f'Expected html to have type str, not {type(html)}'
-        assert len(html) > 300
-        assert len(html.splitlines()) > 100
-        assert html.startswith('<!DOCTYPE html><html><head>')
-        assert html.endswith('</body></html>')
-        assert "<div class='storytext xcontrast_txt nocopy' id='storytext'>" in html
-        return html
+    See download_many to download several chapters at once.
+    '''
 
     # Guard clause: If local file, just return it.
     if not url.startswith('http'):
         print(f'URL {url} is not HTTP; assuming it\'s a local file and returning it.')
-        return verify_html(open(url).read())
+        return verify_html(chapter_text(url))
 
     # Else, download the remote url and return the text HTML.
     from selenium import webdriver
@@ -47,29 +554,322 @@ def download(url, saveas=None):
     d.close()
 
     verify_html(html)
-    if saveas: open(saveas,'w').write(html)
+    if saveas: save(saveas, html)
     return html
 
-def prune_html(html, saveas=None):
+
+# Ways to fetch a web page for download_many. Each one returns a pair
+# of functions: fetch(url) -> html, and close() to clean up.
+
+def selenium_session():
+    from selenium import webdriver
+    d = webdriver.Firefox()
+    def fetch(url):
+        d.get(url)
+        return d.page_source
+    return fetch, d.quit
+
+def urllib_session():
+    'Plain HTTP, no browser. Handy for serve_cached_chapters.'
+    from urllib.request import urlopen
+    def fetch(url):
+        with urlopen(url, timeout=60) as r:
+            return r.read().decode('utf-8')
+    return fetch, lambda: None
+
+DOWNLOAD_SESSIONS = { 'selenium': selenium_session
+                    , 'urllib'  : urllib_session
+                    }
+
+def write_atomically(path, text):
+    'Write to a temp file, then rename it, so nobody ever sees a half-written file.'
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp,'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def download_many(urls, saveas=None, session='selenium', workers=2, interval=5.0, retries=3, on_done=None, on_error=None):
+    '''
+    Step A, for many chapters at once: Download each of urls, returning a list of HTML strings.
+    If given, saveas is a list of filenames, one per URL.
+
+    Starting Firefox is the slowest part of downloading a chapter, so rather than
+    opening a new browser for every chapter like download() does, we keep a pool
+    of `workers` browsers (one per thread), and reuse them.
+
+    To be polite (and to not look like a bot), we start at most one download from
+    each host every `interval` seconds, no matter how many workers there are.
+    If a page doesn't look right (see verify_html), eg, we got a captcha page,
+    we close that browser, wait a while (twice as long each time), and try again
+    with a fresh one, up to `retries` more times.
+
+    session is one of DOWNLOAD_SESSIONS.
+    If given, on_done(j, html) is called (in the downloading thread) as soon as urls[j] is in,
+    eg to start on it before the other chapters arrive (see build.py --async).
+    If given, on_error(j, e) is called when urls[j] fails for good, instead of raising e, and its HTML is None,
+    eg so one story's missing chapter doesn't stop the other stories' downloads (see build-batch.py).
+    '''
+    import urllib.parse
+    from concurrent.futures import ThreadPoolExecutor
+
+    urls = list(urls)
+    saveas = saveas or [None]*len(urls)
+    new_session = DOWNLOAD_SESSIONS[session]
+
+    lock = threading.Lock()
+    next_start = {} # host -> earliest time we may start the next download from it
+    local = threading.local()
+    sessions = []
+
+    def wait_for_turn(url):
+        host = urllib.parse.urlsplit(url).netloc
+        with lock:
+            t = max(time.monotonic(), next_start.get(host, 0))
+            next_start[host] = t + interval
+        time.sleep(max(0, t - time.monotonic()))
+
+    def get_session():
+        if getattr(local, 'session', None) is None:
+            local.session = new_session()
+            with lock: sessions.append(local.session)
+        return local.session
+
+    def drop_session():
+        fetch, close = local.session
+        close()
+        with lock: sessions.remove(local.session)
+        local.session = None
+
+    def download_one(url, fout):
+        with trace_span('download', trace_label(url, fout)) as span:
+            for attempt in range(retries+1):
+                span['attempts'] = attempt+1
+                if attempt > 0:
+                    time.sleep(interval * 2**attempt)
+                wait_for_turn(url)
+                fetch, _ = get_session()
+                try:
+                    html = verify_html(fetch(url))
+                except Exception as e:
+                    print(f'download_many: attempt #{attempt+1} at {url} failed: {e!r}')
+                    drop_session()
+                    continue
+                print(f'download_many: got {url}')
+                if fout: write_atomically(fout, html)
+                span['bytes_out'] = data_size(html)
+                return html
+            raise RuntimeError(f'download_many: gave up on {url} after {retries+1} attempts')
+
+    def download_and_hand_on(j, url, fout):
+        try:
+            html = download_one(url, fout)
+        except Exception as e:
+            if not on_error: raise
+            on_error(j, e)
+            return None
+        if on_done: on_done(j, html)
+        return html
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            return list(ex.map(download_and_hand_on, range(len(urls)), urls, saveas))
+    finally:
+        for _, close in sessions:
+            close()
+
+
+def serve_cached_chapters(port=0, files_dir='files'):
+    '''
+    A stand-in for fanfiction.net, for trying out download_many without hitting the real site:
+    serve files/NN_a_orig.html at http://localhost:port/s/<story id>/<NN>/<title>.
+    For several stories, put "{story}" in files_dir, eg files_dir='books/{story}/files'.
+    Runs in a background thread; returns the server, whose address is server.host.
+    Use server.shutdown() to stop it.
     '''
-    Step B: Discard non-story HTML from 1_a_orig.html, creating 1_b_pruned.html.
 
-    Insert the chapter name to an <h1> tag, so it appears as Chater headings in the LaTeX files later.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            m = re.fullmatch(r'/s/(\d+)/(\d+)/[^/]*', self.path)
+            f = m and os.path.join(files_dir.format(story=m.group(1)), f'{int(m.group(2)):02}_a_orig.html')
+            if not f or not os.path.isfile(f):
+                self.send_error(404)
+                return
+            body = open(f,'rb').read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.host = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def chapter_name_from_title(title):
+    # eg "The Metropolitan Man Chapter 1: Literally Incredible, a superman fanfic | FanFiction".
+    # One-chapter stories have no "Chapter 1: ...", so use the story's name.
+    m = ( re.search(r'Chapter \d+: (.*), an? [^,]* fanfic', title)
+       or re.search(r'(.*), an? [^,]* fanfic', title) )
+    return m.group(1)
+
+def prune_html_bs4(html):
+    '''
+    Find the story <div> and the chapter name with BeautifulSoup,
+    returning the story <div>, with the chapter name in an <h1> tag.
+    Slow, because it parses the whole page, but sure.
     '''
 
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html, features='html.parser')
     story = soup.find(id='storytext')
     story.attrs = None
-    chapter_name = re.search(
-        r'Chapter \d+: (.*), a superman fanfic',
-        soup.title.text
-        ).group(1)
+    chapter_name = chapter_name_from_title(soup.title.text)
 
     h = soup.new_tag('h1')
     h.string = chapter_name
     story.insert(0, h)
 
-    txt = str(story)
+    return str(story)
+
+
+STORYTEXT_DIV = "<div class='storytext xcontrast_txt nocopy' id='storytext'>"
+
+# Tags that BeautifulSoup writes like <hr/>, and never closes.
+VOID_ELEMENTS = { 'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem'
+                , 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame'
+                , 'image', 'isindex', 'nextid', 'spacer' }
+
+# The only named entities we're sure we decode the same as BeautifulSoup.
+SIMPLE_ENTITIES = { 'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'", 'nbsp': '\xa0' }
+
+def escape_html(s):
+    'Escape text like BeautifulSoup does when it writes HTML.'
+    return s.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+
+@lru_cache(maxsize=None)
+def storytext_serializer():
+    'The StorytextSerializer class (made the first time it\'s needed, so importing lib doesn\'t import html.parser).'
+    from html.parser import HTMLParser
+
+    class StorytextSerializer(HTMLParser):
+        '''
+        Writes out the HTML inside the storytext <div> exactly like BeautifulSoup
+        (with features='html.parser') would, without building a tree.
+        BeautifulSoup uses this same HTMLParser to read the HTML, so we see the same tags and text.
+
+        Feed it the HTML right after the storytext <div> tag. It raises Done when the
+        <div> closes, so we never look at the rest of the page, and Unsure if it sees
+        anything where BeautifulSoup might do something different (eg unbalanced tags,
+        comments, <script>s, unusual entities), so that the caller can use BeautifulSoup instead.
+        '''
+
+        class Done(Exception): pass
+        class Unsure(Exception): pass
+
+        def __init__(self):
+            super().__init__(convert_charrefs=False) # same as BeautifulSoup
+            self.out = []
+            self.open_tags = ['div']
+
+        def handle_starttag(self, tag, attrs):
+            if tag in ('script', 'style'): raise self.Unsure(tag) # BeautifulSoup doesn't escape their text
+            s = ''
+            for k, v in sorted(dict(attrs).items()): # BeautifulSoup sorts the attributes
+                v = escape_html(v or '')
+                if '"' not in v:   s += f' {k}="{v}"'
+                elif "'" not in v: s += f" {k}='{v}'"
+                else:              s += f''' {k}="{v.replace('"', '&quot;')}"'''
+            if tag in VOID_ELEMENTS:
+                self.out.append(f'<{tag}{s}/>')
+            else:
+                self.out.append(f'<{tag}{s}>')
+                self.open_tags.append(tag)
+
+        def handle_startendtag(self, tag, attrs): # eg <br/>
+            self.handle_starttag(tag, attrs)
+            if tag not in VOID_ELEMENTS: self.handle_endtag(tag)
+
+        def handle_endtag(self, tag):
+            if self.open_tags[-1] != tag: raise self.Unsure(f'</{tag}>')
+            self.open_tags.pop()
+            if not self.open_tags: raise self.Done()
+            self.out.append(f'</{tag}>')
+
+        def handle_data(self, data):
+            self.out.append(escape_html(data))
+
+        def handle_entityref(self, name):
+            if name not in SIMPLE_ENTITIES: raise self.Unsure(f'&{name};')
+            self.handle_data(SIMPLE_ENTITIES[name])
+
+        def handle_charref(self, name):
+            n = int(name[1:], 16) if name[0] in 'xX' else int(name)
+            if not (0 < n < 128 or 160 <= n < 0xD800): raise self.Unsure(f'&#{name};') # BeautifulSoup treats 128-159 as windows-1252
+            self.handle_data(chr(n))
+
+        def handle_comment(self, data):   raise self.Unsure('comment')
+        def handle_decl(self, decl):      raise self.Unsure('decl')
+        def handle_pi(self, data):        raise self.Unsure('pi')
+        def unknown_decl(self, data):     raise self.Unsure('decl')
+
+    return StorytextSerializer
+
+def prune_html_fast(html):
+    '''
+    Like prune_html_bs4, but rather than parsing the whole page,
+    jump straight to the <title> and the storytext <div> and only parse the story,
+    stopping when its <div> closes. Returns None if it can't be sure the result
+    would be the same as prune_html_bs4.
+    '''
+
+    start = html.find(STORYTEXT_DIV)
+    title = re.search(r'<title\b[^>]*>([^<&]*)</title>', html, re.IGNORECASE)
+    if start < 0 or not title or re.search(r'''\bid\s*=\s*(?:'storytext'|"storytext"|storytext[\s/>])''', html[:start]):
+        return None
+    if re.search(r'<title\b', html[:title.start()], re.IGNORECASE):
+        return None
+
+    StorytextSerializer = storytext_serializer()
+    s = StorytextSerializer()
+    try:
+        s.feed(html[start+len(STORYTEXT_DIV):])
+        s.close()
+        return None # the <div> never closed
+    except StorytextSerializer.Unsure as e:
+        print(f'prune_html_fast: unsure about {e}')
+        return None
+    except StorytextSerializer.Done:
+        pass
+
+    h1 = f'<h1>{escape_html(chapter_name_from_title(title.group(1)))}</h1>'
+    return '<div>' + h1 + ''.join(s.out) + '</div>'
+
+PRUNE_HTML_PARSERS = { 'fast': prune_html_fast
+                     , 'bs4' : prune_html_bs4
+                     }
+
+@traced
+def prune_html(html, saveas=None, parser='fast'):
+    '''
+    Step B: Discard non-story HTML from 1_a_orig.html, creating 1_b_pruned.html.
+
+    Insert the chapter name to an <h1> tag, so it appears as Chater headings in the LaTeX files later.
+
+    parser is one of PRUNE_HTML_PARSERS: 'fast' (the default) only parses the story itself,
+    and falls back to 'bs4' (BeautifulSoup) when the HTML looks unusual.
+    Both give exactly the same result; use parser='bs4' to double-check.
+    '''
+
+    txt = PRUNE_HTML_PARSERS[parser](html)
+    if txt is None:
+        print(f'prune_html: falling back to BeautifulSoup.')
+        txt = prune_html_bs4(html)
     txt += '\n'
 
     assert type(txt) == str
@@ -78,106 +878,188 @@ def prune_html(html, saveas=None):
     assert txt.startswith('<div><h1>')
     assert txt.endswith('</p>\n</div>\n'), f'Wrong ending: {txt[-20:]}'
 
-    if saveas: open(saveas,'w').write(txt)
+    if saveas: save(saveas, txt)
     return txt
 
 
-def fix_html(html, saveas=None):
-    '''
-    Step C: Fix HTML formatting issues in 1_b_pruned.html, creating 1_c_fix.html.
 
-    - Fix typos, hyphenation, slashes, and ellipses:
-    - Replace "reviews/favorites" with "reviews / favorites" etc
-      for better linebreaking. Note: a/b/c/d/e requires two separate
-      replacement passes; the first only yields a / b/c / d/e .
-    - Note that the HTML is all one long line -- needed to prevent
-      incorrect spaces when parsed by pandoc and tex.
+def compile_rules(rules):
+    '''
+    Compile a list of [name, pattern, replacement] rules into a single function
+    that rewrites a string in ONE scan, instead of one re.sub per rule.
+
+    All the patterns are joined into one big alternation regex, each followed by
+    an empty marker group "()", and the match callback dispatches on which
+    marker matched (m.lastindex). The replacement is either a literal string or
+    a function that takes the match object (handy for looking at the neighboring
+    characters).
+
+    Notes:
+
+    - At any position, earlier rules in the list win over later ones.
+    - Rules shouldn't consume context they don't replace. Use lookarounds
+      like (?<=...) and (?=...) instead; then overlapping cases like
+      "bric-a-brac" are handled in one pass, with no need to run twice.
+    - Start each pattern with a literal character, and put any lookbehind
+      AFTER it (eg r'/(?<=abc/)' rather than r'(?<=abc)/'). Then the regex
+      engine can jump straight to the next place a rule could match,
+      instead of trying every rule at every position (which is slower
+      than running one re.sub per rule!).
+    - Patterns can't contain capturing groups or a top-level "|"; use (?:...) instead.
     '''
 
-    def fix_html_typos(s):
-        for old, new in [
-              [ 'spaceship inside..'               , 'spaceship inside.'                   ]
-            , [ 'I got opening portion'            , 'I got the opening portion'           ]
-            , [ 'as a mathematician"'              , 'as a mathematician."'                ]
-            , [ 'December 19th, 1934</p>'          , 'December 19th, 1934:</p>'            ]
-            , [ 'as he stood..'                    , 'as he stood.'                        ]
-            , [ 'Genesis 18:23 '                   , 'Genesis 18:23, '                     ]
-            , [ 'a hundreds of millions'           , 'hundreds of millions'                ]
-            , [ 'hammered down the keys to,'       , 'hammered down the keys,'             ]
-            , [ 'insane. She could decide whether' , "insane. She couldn't decide whether" ]
-            , [ 'overwhelm positive effects'       , 'overwhelm the positive effects'      ]
-        ]:
-            s = s.replace(old, new)
-        return s
-
-    def fix_html_hyphens(s):
-        '''
-        Replace --- with em-dash and -- with en-dash, then replace all 
-        remaining '-' characters with hyphen, en-dash, or em-dash as appropriate.
-
-        Hyphenation rules:
-
-        - "pages 10-20" : en-dash
-        - "his well-being" : hyphen (letters)
-        - "Uranium U-238" : hyphen (letter & number)
-        - "I thought -" : em-dash for all other cases
-
-        Note: each replacement needs to be run twice to deal with cases
-        like "bric-a-brac" where re.sub doesn't replace the 2nd "-" because
-        it resumed replacement after the 2nd matched group (the "a").
-        
-        WARNING / NOTE: pandoc replaces hyphens not with the "-" character 
-        (ascii code 45, unicode name HYPHEN-MINUS)
-        but with the "‐" character ('ascii' code 8208, unicode name HYPHEN).
-        '''
+    regex = re.compile('|'.join(f'{pat}()' for _, pat, _ in rules))
+    repls = {k+1: repl for k, (_, _, repl) in enumerate(rules)}
+
+    def dispatch(m):
+        repl = repls[m.lastindex]
+        return repl(m) if callable(repl) else repl
+
+    return lambda s: regex.sub(dispatch, s)
+
+
+# Rule index: which chapters each rule of fix_html and fix_tex changes.
+#
+# fix_html and fix_tex run each pass of rules as one combined regex (see compile_rules), compiled the
+# first time it's used. rule_report() shows, for each rule, how many times it matches in each chapter
+# on its own, which takes a regex search per rule per chapter. So it keeps those counts in an index:
+# for each pass's input text (by its hash), how many times each rule matches in it (by a hash of its
+# pattern and replacement). The index is kept in the stage cache (see cache_get and cache_put), which
+# evicts the least recently used entries, so when a rule is added or changed, the next report only has
+# to try that rule on each chapter, not all of them.
+
+_compiled_rules = {} # tuple of rule hashes -> compile_rules() of those rules
+
+@lru_cache(maxsize=None)
+def rule_hash(pat, repl):
+    import inspect
+    return hashlib.sha256(json.dumps([pat, repl], default=inspect.getsource).encode('utf-8')).hexdigest()[:16]
+
+def rule_counts(rules, text):
+    'How many times each of rules matches in text, on its own (a list, in the same order). See above.'
+    key = 'rules-' + text_hash(text)
+    counts = json.loads(cache_get(key) or '{}')
+    hashes = [ rule_hash(pat, repl) for _, pat, repl in rules ]
+    missing = [ (h, pat) for h, (_, pat, _) in zip(hashes, rules) if h not in counts ]
+    for h, pat in missing:
+        counts[h] = sum( 1 for _ in re.finditer(pat, text) )
+    if missing:
+        cache_put(key, json.dumps(counts))
+    return [ counts[h] for h in hashes ]
+
+def apply_rules(passes, text):
+    'Run each pass of rules over text (see compile_rules), compiling each pass once per process.'
+    for rules in passes:
+        key = tuple( rule_hash(pat, repl) for _, pat, repl in rules )
+        if key not in _compiled_rules:
+            _compiled_rules[key] = compile_rules(rules)
+        text = _compiled_rules[key](text)
+    return text
+
+def rule_report(files_dir='files', pack=None):
+    '''
+    For each rule of fix_html and fix_tex, which chapters in files_dir (or the chapter archive pack) it changes,
+    and how many times (eg "05:2" means twice in chapter 5). Rules that don't change any chapter are marked DEAD.
+    '''
+    lines = []
+    for step, passes, suffix in [ ('fix_html', FIX_HTML_PASSES, '_b_pruned.html')
+                                , ('fix_tex' , FIX_TEX_PASSES , '_d_pandoc.tex' ) ]:
+        hits = {} # rule name -> [ 'chapter:count', ... ]
+        for f in sorted(pack_index(pack) if pack else os.listdir(files_dir)):
+            if not f.endswith(suffix): continue
+            text = pack_read(pack, f) if pack else open(os.path.join(files_dir, f)).read()
+            for rules in passes:
+                for (name, _, _), n in zip(rules, rule_counts(rules, text)):
+                    hits.setdefault(name, [])
+                    if n: hits[name].append(f'{f[:2]}:{n}')
+                text = apply_rules([rules], text)
+        for name, chapters in hits.items():
+            lines.append(f'{step:<9} {name:<44} ' + (' '.join(chapters) if chapters else 'DEAD'))
+    return '\n'.join(lines)
+
+
+FIX_HTML_TYPOS = [
+      [ 'spaceship inside..'               , 'spaceship inside.'                   ]
+    , [ 'I got opening portion'            , 'I got the opening portion'           ]
+    , [ 'as a mathematician"'              , 'as a mathematician."'                ]
+    , [ 'December 19th, 1934</p>'          , 'December 19th, 1934:</p>'            ]
+    , [ 'as he stood..'                    , 'as he stood.'                        ]
+    , [ 'Genesis 18:23 '                   , 'Genesis 18:23, '                     ]
+    , [ 'a hundreds of millions'           , 'hundreds of millions'                ]
+    , [ 'hammered down the keys to,'       , 'hammered down the keys,'             ]
+    , [ 'insane. She could decide whether' , "insane. She couldn't decide whether" ]
+    , [ 'overwhelm positive effects'       , 'overwhelm the positive effects'      ]
+]
+
+def fix_html_hyphens(m):
+    '''
+    Replace a run of '-' characters with hyphens, en-dashes, or em-dashes as appropriate.
 
-        for old, new in [
-              [  r'([^-])---([^-])'               ,  r'\1&mdash;\2'   ]
-            , [  r'([^-])--([^-])'                ,  r'\1&ndash;\2'   ]
-            , [  r'([0-9])-([0-9])'               ,  r'\1&ndash;\2'   ]
-            , [  r'([a-zA-Z0-9])-([a-zA-Z0-9])'   ,  r'\1&hyphen;\2'  ]
-            , [  r'-'                             ,  r'&mdash;'       ]
-        ]:
-            s = re.sub(old, new, s)
-            s = re.sub(old, new, s)
-        return s
+    The match is a whole run of dashes, so the characters on either side
+    (if any) are never '-'. Hyphenation rules:
 
-    def fix_html_slashes(s):
-        '''
-        The phrase "reviews/comments/favorites/recommendations" needs to appear
-        as "reviews / comments / favorites / recommendations" otherwise
-        tex typesets it as a single huge word.
-        
-        Note: gotta run this pattern twice, because the first
-        pass continues parsing the line after the matching foo/bar,
-        resulting in "reviews / comments/favorites / recommendations".
-        '''
+    - "pages 10-20" : en-dash
+    - "his well-being" : hyphen (letters)
+    - "Uranium U-238" : hyphen (letter & number)
+    - "I thought -" : em-dash for all other cases
+    - "a---b" : em-dash, and "a--b" : en-dash
+    - Any other run (eg "----", or at the very start/end) : one em-dash per '-'
 
-        old = r'([a-zA-Z]{3,})/([a-zA-Z]{3,})'
-        new = r'\1 / \2'
-        s = re.sub(old, new, s)
-        s = re.sub(old, new, s)
-        return s
+    WARNING / NOTE: pandoc replaces hyphens not with the "-" character 
+    (ascii code 45, unicode name HYPHEN-MINUS)
+    but with the "‐" character ('ascii' code 8208, unicode name HYPHEN).
+    '''
 
+    s, i, j = m.string, m.start(), m.end()
+    before = s[i-1] if i > 0 else ''
+    after = s[j] if j < len(s) else ''
+    digits = '0123456789'
+    alnum = digits + 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+    if before and after:
+        if j-i == 3: return '&mdash;'
+        if j-i == 2: return '&ndash;'
+        if j-i == 1 and before in digits and after in digits: return '&ndash;'
+        if j-i == 1 and before in alnum and after in alnum: return '&hyphen;'
+    return (j-i) * '&mdash;'
+
+# Rules for fix_html (after the typos are fixed), in priority order. See compile_rules().
+FIX_HTML_RULES = [
+      [ 'hyphens'  , r'--*'                               , fix_html_hyphens ]
+
+      # The phrase "reviews/comments/favorites/recommendations" needs to appear
+      # as "reviews / comments / favorites / recommendations" otherwise
+      # tex typesets it as a single huge word.
+    , [ 'slashes'  , r'/(?<=[a-zA-Z]{3}/)(?=[a-zA-Z]{3})' , ' / '            ]
+
+      # Replace "..." with the unicode "…" for uniformity, and remove the space
+      # before an ellipsis, ie, convert "he said ..." into "he said..." .
+      # This looks better and also prevents linebreaks before "..." .
+    , [ 'ellipses1', r' (?<=[a-zA-Z0-9] )(?:\.\.\.|…)'    , '…'              ]
+    , [ 'ellipses2', r'\.\.\.'                            , '…'              ]
+]
+
+# The typos get their own pass, because fixing them can create new
+# matches for the other rules (eg "spaceship inside....." --> "spaceship inside….").
+FIX_HTML_PASSES = [ [ [f'typo {old!r}', re.escape(old), new] for old, new in FIX_HTML_TYPOS ]
+                  , FIX_HTML_RULES
+                  ]
 
-    def fix_html_ellipses(s):
-        # 1. Replace "..." with the unicode "…" for uniformity.
-        s = re.sub(r'\.\.\.','…',s)
+@traced
+def fix_html(html, saveas=None):
+    '''
+    Step C: Fix HTML formatting issues in 1_b_pruned.html, creating 1_c_fix.html.
 
-        # 2. Remove space before ellipsis, ie,
-        #    convert "he said ..." into "he said..." .
-        #    This looks better and also prevents linebreaks before "..." .
-        s = re.sub( r'([a-zA-Z0-9]) …', r'\1…', s)
-        return s
+    - Fix typos (one pass), then hyphenation, slashes, and ellipses
+      (one more pass). See FIX_HTML_TYPOS, FIX_HTML_RULES, and compile_rules.
+    - Replace "reviews/favorites" with "reviews / favorites" etc
+      for better linebreaking. (The old re.sub version needed two
+      passes for a/b/c/d/e; the lookarounds in the slash rule don't.)
+    - Note that the HTML is all one long line -- needed to prevent
+      incorrect spaces when parsed by pandoc and tex.
+    '''
 
-    html = reduce( lambda x,f: f(x)
-                 , [ fix_html_typos
-                   , fix_html_hyphens
-                   , fix_html_slashes
-                   , fix_html_ellipses
-                   ]
-                 , html
-                 )
+    html = apply_rules(FIX_HTML_PASSES, html)
 
     assert type(html) == str
     assert len(html) > 300
@@ -185,10 +1067,17 @@ def fix_html(html, saveas=None):
     assert html.startswith('<div><h1>')
     assert html.endswith('</p>\n</div>\n'), f'Wrong ending: {html[-20:]}'
 
-    if saveas: open(saveas,'w').write(html)
+    if saveas: save(saveas, html)
     return html
 
 
+PANDOC_CMD = [ 'pandoc'
+             , '-f', 'html+smart'
+             , '-t', 'latex+smart'
+             , '--top-level-division=chapter'
+             ]
+
+@traced
 def html_to_tex(html, saveas=None):
     '''
     Step D: Use pandoc to convert HTML 1_c_fix.html to TEX 1_d_pandoc.tex.
@@ -206,11 +1095,7 @@ def html_to_tex(html, saveas=None):
     '''
 
     p = subprocess.run( # TODO: subprocess.check_output returns stdout
-            [ 'pandoc'
-            , '-f', 'html+smart'
-            , '-t', 'latex+smart'
-            , '--top-level-division=chapter'
-            ]
+            PANDOC_CMD
             , capture_output=True
             , text=True
             , check=True
@@ -227,140 +1112,1182 @@ def html_to_tex(html, saveas=None):
     assert len(tex) > 300
     assert len(tex.splitlines()) > 100
 
-    if saveas: open(saveas,'w').write(tex)
+    if saveas: save(saveas, tex)
     return tex
 
-def fix_tex(tex, saveas=None):
+async def html_to_tex_async(html, saveas=None):
     '''
-    Step E: Fix TEX formatting issues, creating 1_e_good.tex.
+    Step D, for run_pipeline: the same as html_to_tex, but the event loop carries on
+    (eg with other chapters' downloads and steps) while pandoc runs.
     '''
+    import asyncio
+    with trace_span( 'html_to_tex', trace_label(html, saveas)
+                   , bytes_in=data_size(html), cache=getattr(_trace, 'cache', None) ) as span:
+        p = await asyncio.create_subprocess_exec( *PANDOC_CMD
+                                                , stdin=subprocess.PIPE
+                                                , stdout=subprocess.PIPE
+                                                , stderr=subprocess.PIPE
+                                                )
+        out, err = await p.communicate(html.encode('utf-8'))
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, PANDOC_CMD, out, err)
+        # Decode the way subprocess.run(text=True) does, so the TeX comes out the same as html_to_tex's.
+        tex, err = [ b.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n') for b in (out, err) ]
+        print(f'pandoc run:')
+        print(f'returncode: {p.returncode}')
+        print(f'len stdout: {len(tex)}')
+        print(f'stderr: "{err}"')
+
+        assert type(tex) == str
+        assert len(tex) > 300
+        assert len(tex.splitlines()) > 100
+        span['bytes_out'] = data_size(tex)
+
+    if saveas: save(saveas, tex)
+    return tex
 
-    def fix_tex_smartquotes(s):
-        '''
-        In theory, since we used pandoc with latex+smart (to make ``smart quotes''),
-        there should be no normal double-quotes ("). But it missed some (at least 
-        with the version of pandoc I used when I first wrote this in 2017). 
-        So let's make extra-sure.
-        '''
-
-        s = re.sub(r'"([a-zA-Z0-9\.,!\-\?])', r'``\1', s) # "Hello ...  --> ``Hello ...
-        s = re.sub(r'([a-zA-Z0-9\.,!\-\?])"', r"\1''", s) # ... end." --> ... end.''
-        return s
-
-    def fix_tex_newlines(s):
-        '''
-        Fix 2 problems with linebreaks near em-dashes.
-
-        (1) Don't linebreak ``he said ---'' into ``he said\n---'' .
-            Use a non-breaking space ``he said~---'' to acheive this.
-
-        (2) Don't linebreak between emdash and close-quote, ie,
-            don't linebreak ``he said ---'' into ``he said ---\n'' .
-            To do this, replace --- with \=== which is a non-breaking em-dash
-            provided by the extdash latex package (see header.tex).
-        
-            Note: Can't simply use nonbreaking em-dashes everywhere, because
-            for some reason they eat the spaces surrounding them and it
-            looks ugly. So use nonbreaking em-dashes ONLY before close-quotes.
-        '''
-
-        s = re.sub(r'([a-zA-Z0-9]) ---', r'\1~---', s)
-        s = re.sub(r"---''", r"\\===''", s)
-        return s
+PANDOC_BATCH_SEPARATOR = 'PandocBatchSeparatorQz'
 
-    def fix_tex_final_one_off_problems(s):
-        '''
-        Crappy line-breaking: in the final typeset PDF, the particular text
+@traced
+def html_to_tex_batch(htmls, saveas=None):
+    r'''
+    Step D, batched: Like html_to_tex, but convert a list of chapters with a single pandoc run,
+    returning a list of TEX strings. If given, saveas is a list of filenames, one per chapter.
 
-          pistols into your home---''
+    Starting pandoc (a Haskell program) takes a noticeable fraction of a second, so rather
+    than pay for that once per chapter, we glue the chapters together with a separator
+    paragraph <p>PandocBatchSeparatorQz</p>, convert them all at once, and split the TeX back
+    apart on the separator. Pandoc puts a blank line between blocks, so each piece comes out
+    exactly like html_to_tex would've made it, except for the trailing newline, which we add back.
 
-        extends into the margin.
+    Warning: pandoc makes sure the \label{}s of headings are unique, so if two chapters
+    have a heading with the same name, the 2nd one would get \label{name-1} in the batch
+    but \label{name} on its own. If it looks like that happened, or the separator
+    went missing, we fall back to running pandoc once per chapter.
+    '''
 
-        Solution: force newline: 
+    htmls = list(htmls)
+    saveas = saveas or [None]*len(htmls)
+    sep = PANDOC_BATCH_SEPARATOR
 
-          pistols into your \\ home---''
+    p = subprocess.run(
+            PANDOC_CMD
+            , capture_output=True
+            , text=True
+            , check=True
+            , input=f'<p>{sep}</p>\n'.join(htmls)
+            )
+    print(f'pandoc batch run ({len(htmls)} chapters):')
+    print(f'returncode: {p.returncode}')
+    print(f'len stdout: {len(p.stdout)}')
+    print(f'stderr: "{p.stderr}"')
 
-        Warning: since the TeX files are not one long line, this 
-        function is vulnerable to breaking if pandoc ever writes 
-        the tex file like "pistols into \n your home".
-        '''
+    parts = p.stdout.split(f'\n\n{sep}\n\n')
+    texs = [ t+'\n' for t in parts[:-1] ] + parts[-1:]
+
+    labels = set(re.findall(r'\\label\{([^}]*)\}', p.stdout))
+    def renamed(label): # eg "name-1", when "name" is also a label
+        m = re.fullmatch(r'(.*)-\d+', label)
+        return m and m.group(1) in labels
+
+    if len(texs) != len(htmls) or any(sep in h for h in htmls) or any(map(renamed, labels)):
+        print(f'pandoc batch run: can\'t safely split the output, converting each chapter separately.')
+        return [ html_to_tex(h, saveas=f) for h, f in zip(htmls, saveas) ]
+
+    for tex, f in zip(texs, saveas):
+        assert type(tex) == str
+        assert len(tex) > 300
+        assert len(tex.splitlines()) > 100
+
+        if f: save(f, tex)
+    return texs
+
+# Rules for fix_tex. These take two passes, because the
+# nonbreaking em-dash rule needs to see the close-quotes made by the smart-quote rules.
+
+FIX_TEX_SMARTQUOTES = [
+    # In theory, since we used pandoc with latex+smart (to make ``smart quotes''),
+    # there should be no normal double-quotes ("). But it missed some (at least 
+    # with the version of pandoc I used when I first wrote this in 2017). 
+    # So let's make extra-sure.
+      [ 'open_quote' , r'"(?=[a-zA-Z0-9\.,!\-\?])'   , '``' ]  # "Hello ...  --> ``Hello ...
+    , [ 'close_quote', r'"(?<=[a-zA-Z0-9\.,!\-\?]")' , "''" ]  # ... end." --> ... end.''
+]
+
+FIX_TEX_NEWLINES = [
+    # Fix 2 problems with linebreaks near em-dashes.
+    #
+    # (1) Don't linebreak ``he said ---'' into ``he said\n---'' .
+    #     Use a non-breaking space ``he said~---'' to acheive this.
+    #
+    # (2) Don't linebreak between emdash and close-quote, ie,
+    #     don't linebreak ``he said ---'' into ``he said ---\n'' .
+    #     To do this, replace --- with \=== which is a non-breaking em-dash
+    #     provided by the extdash latex package (see header.tex).
+    #
+    #     Note: Can't simply use nonbreaking em-dashes everywhere, because
+    #     for some reason they eat the spaces surrounding them and it
+    #     looks ugly. So use nonbreaking em-dashes ONLY before close-quotes.
+      [ 'nonbreaking_space' , r' (?<=[a-zA-Z0-9] )(?=---)', '~'    ]
+    , [ 'nonbreaking_emdash', r"---(?='')"                , r'\===' ]
+]
+
+FIX_TEX_FINAL_ONE_OFF_PROBLEMS = [
+    # Crappy line-breaking: in the final typeset PDF, the particular text
+    #
+    #   pistols into your home---''
+    #
+    # extends into the margin.
+    #
+    # Solution: force newline: 
+    #
+    #   pistols into your \\ home---''
+    #
+    # Warning: since the TeX files are not one long line, this 
+    # rule is vulnerable to breaking if pandoc ever writes 
+    # the tex file like "pistols into \n your home".
+      [ 'pistols', r' (?<=pistols into your )(?=home)', r' \\ ' ]
+]
+
+FIX_TEX_PASSES = [ FIX_TEX_SMARTQUOTES
+                 , FIX_TEX_NEWLINES + FIX_TEX_FINAL_ONE_OFF_PROBLEMS
+                 ]
+
+@traced
+def fix_tex(tex, saveas=None):
+    '''
+    Step E: Fix TEX formatting issues, creating 1_e_good.tex.
 
-        s = re.sub(r'pistols into your home', r'pistols into your \\\\ home', s)
-        return s
+    See FIX_TEX_SMARTQUOTES, FIX_TEX_NEWLINES, and FIX_TEX_FINAL_ONE_OFF_PROBLEMS.
+    '''
 
-    tex = reduce( lambda x,f: f(x)
-                , [ fix_tex_smartquotes
-                  , fix_tex_newlines
-                  , fix_tex_final_one_off_problems 
-                  ]
-                , tex
-                )
+    tex = apply_rules(FIX_TEX_PASSES, tex)
 
     assert type(tex) == str
     assert len(tex) > 300
     assert len(tex.splitlines()) > 100
 
-    if saveas: open(saveas,'w').write(tex)
+    if saveas: save(saveas, tex)
     return tex
 
 
-def make_final_tex(texs, saveas):
+
+# Checking the chapters' TeX before typesetting them.
+#
+# pdflatex takes seconds, and runs in batchmode, so eg a stray { in a chapter only shows up as a
+# failed run at the very end (or a PDF that looks wrong). lint_tex looks for the likely problems
+# in one pass over a chapter, in a few milliseconds:
+#
+#   - errors: unbalanced { } and \begin \end, ASCII double quotes (which FIX_TEX_SMARTQUOTES should have fixed),
+#     and \=== not followed by '' (see FIX_TEX_NEWLINES);
+#   - warnings: unescaped special characters (# $ & _ ^), em-dashes FIX_TEX_NEWLINES should have made nonbreaking,
+#     and long runs of text that TeX can't break across lines, which may stick out into the margin
+#     (like "pistols into your home", see FIX_TEX_FINAL_ONE_OFF_PROBLEMS). A nonbreaking em-dash eats the space
+#     after it, so it counts as part of the run; TeX can break after a hyphen, including pandoc's ‐
+#     (see fix_html_hyphens), so that ends a run.
+#
+# Comments, \verb, verbatim environments, and the arguments of \label and \url (and the URL of \href)
+# are skipped, since # & _ etc are fine there. Special characters are legal in other places lint_tex
+# doesn't know about, too, so they're only warnings.
+
+LINT_LONG_RUN = 30 # characters
+
+# Everything lint_tex looks at starts with one of the characters in the lookahead, which lets the
+# regex engine skip straight over the plain text in between.
+LINT_TOKENS = lazy_regex(r"""(?=[\\{}"\#$%&_^-])(?:
+      \\begin\{(?P<verbatim>verbatim\*?|Verbatim|lstlisting)\}.*?\\end\{(?P=verbatim)\} # skipped, like comments
+    | \\(?P<env>begin|end)\{(?P<name>[^{}]*)\}     # eg \begin{center}
+    | \\(?:label|url|href)\{[^{}]*\}                # (labels and URLs may contain _ # & % etc)
+    | \\verb\*?(?P<delim>[^a-zA-Z*\s]).*?(?P=delim)  # eg \verb|a_b|
+    | \\===(?P<dash_quote>'')?                      # a nonbreaking em-dash
+    | \\(?:[a-zA-Z]+|.)                             # any other control sequence, eg \emph, \{, \\, \%
+    | (?P<comment>%[^\n]*)                          # a comment, whose braces etc don't count
+    | (?P<open>\{) | (?P<close>\})
+    | (?P<quote>")
+    | (?P<special>[\#$&_^])
+    | (?P<loose_dash>(?<=[a-zA-Z0-9]\ )---|---'')
+    )""", re.X | re.S)
+
+LINT_DASH_JOINS = lazy_regex(r"\\===''\s+\S+")
+LINT_INVISIBLE = lazy_regex(r'\\(?:label|begin|end|rule)(?:\{[^{}]*\})+|\\[a-zA-Z]+\*?|[{}]')
+
+@traced
+def lint_tex(tex):
     '''
-    Step F: Given a list of strings, each one representing a tex-formatted chapter of
-    the story, concatenate them along with header.tex and footer.tex,
-    saving it into the file specified.
+    Likely problems in a chapter's TeX (see above), as a list of (line number, 'error' or 'warning', message).
+    '''
+    problems = [] # (position in tex, level, message), until the end, when we work out the line numbers
+    open_ = []    # the { and \begin{...} not closed yet: (what, position)
+    for m in LINT_TOKENS.finditer(tex):
+        kind, at = m.lastgroup, m.start()
+        if kind == 'comment':
+            continue
+        elif kind == 'open':
+            open_.append(('{', at))
+        elif kind == 'close':
+            if open_ and open_[-1][0] == '{':
+                open_.pop()
+            else:
+                problems.append((at, 'error', '} without a matching {' + (f' (inside \\begin{{{open_[-1][0]}}})' if open_ else '')))
+        elif m.group('env') == 'begin':
+            open_.append((m.group('name'), at))
+        elif m.group('env') == 'end':
+            name = m.group('name')
+            if name not in [ what for what, _ in open_ ]:
+                problems.append((at, 'error', f'\\end{{{name}}} without a matching \\begin{{{name}}}'))
+                continue
+            while (top := open_.pop())[0] != name: # whatever was left open inside the environment
+                problems.append((top[1], 'error', ('{ never closed' if top[0] == '{' else f'\\begin{{{top[0]}}} never ended')
+                                 + f' (before \\end{{{name}}})'))
+        elif kind == 'quote':
+            problems.append((at, 'error', 'ASCII double quote " (should be `` or \'\')'))
+        elif kind == 'special':
+            problems.append((at, 'warning', f'unescaped special character {m.group()}'))
+        elif kind == 'loose_dash':
+            problems.append((at, 'warning', f'em-dash that could be broken onto its own line: {tex[max(0, at-10):m.end()]!r}'))
+        elif m.group().startswith('\\===') and not m.group('dash_quote'):
+            problems.append((at, 'error', "nonbreaking em-dash \\=== not followed by ''"))
+    for what, at in open_:
+        problems.append((at, 'error', '{ never closed' if what == '{' else f'\\begin{{{what}}} never ended'))
+
+    # Runs of text TeX can't break: only words that are long to begin with, or that are joined by a nonbreaking em-dash, can be too long.
+    runs = {} # position -> run
+    pos = 0
+    spaced = tex.replace('‐', ' ') # the same length, so the positions are the same as in tex
+    for word in spaced.split():
+        if len(word) > LINT_LONG_RUN:
+            pos = spaced.find(word, pos)
+            runs[pos] = word
+            pos += len(word)
+    for m in LINT_DASH_JOINS.finditer(spaced):
+        at = max(spaced.rfind(' ', 0, m.start()), spaced.rfind('\n', 0, m.start())) + 1
+        runs[at] = spaced[at:m.end()]
+    for at, run in runs.items():
+        n = len(LINT_INVISIBLE.sub('', run))
+        if n > LINT_LONG_RUN:
+            problems.append((at, 'warning', f'{n} characters that can\'t be broken across lines: {run!r}'))
+
+    return [ (tex.count('\n', 0, at) + 1, level, msg) for at, level, msg in sorted(problems) ]
+
+def lint_chapters(texs, names, m=map):
+    '''
+    lint_tex on each of the chapters texs: a dict from each name to its problems.
+    To lint several chapters at once, pass the map of a pool of processes (eg build.py's), as m.
+    '''
+    return dict(zip(names, m(lint_tex, texs)))
+
+def lint_report(results):
+    'The problems lint_chapters found, one per line (eg "05_e_good.tex:12: error: } without a matching {"), then the totals.'
+    lines = [ f'{name}:{line}: {level}: {msg}' for name, problems in results.items() for line, level, msg in problems ]
+    counts = [ level for problems in results.values() for _, level, _ in problems ]
+    lines.append(f"lint_tex: {counts.count('error')} errors, {counts.count('warning')} warnings in {len(results)} chapters")
+    return '\n'.join(lines)
+
+def lint_errors(results):
+    'How many errors (as opposed to warnings) lint_chapters found.'
+    return sum( level == 'error' for problems in results.values() for _, level, _ in problems )
+
+
+# Verify that mm.tex is correct; certain fixed strings should appear in it.
+STRS_SHOULD_BE_PRESENT = [
+    "bringing pistols into"
+  , "to explain how I got"
+  , "goodness of humanity"
+  , "he could actually"
+  , "--- that he"
+  , "bric‐a‐brac"
+  , "presumptions."
+]
+
+# The line make_final_tex puts before each chapter in mm.tex (see tex_log_chapters).
+CHAPTER_BANNER = '%%%%%%%%%%%%%%%%%%% NEW CHAPTER %%%%%%%%%%%%%%%%%%%%%%%%'
+
+@traced
+def make_final_tex(texs, saveas, strs_should_be_present=STRS_SHOULD_BE_PRESENT, header='header.tex', footer='footer.tex'):
+    '''
+    Step F: Given a list (or any iterable, eg a generator) of strings, each one representing
+    a tex-formatted chapter of the story, concatenate them along with header.tex and footer.tex
+    (or the given header and footer files), saving it into the file specified.
+    The chapters can also be bytes (UTF-8), eg chapter_bytes('files/01_e_good.tex'),
+    which are copied to the file as they are, without decoding them.
+
+    Each piece is written to the file as soon as we get it, rather than building the whole
+    story as one big string, so only one chapter needs to be in memory at a time.
+    As the pieces go by, we look for all of strs_should_be_present at once, with one regex
+    that matches any of them. To catch strings that straddle two pieces, we also search
+    the end of the previous piece together with the start of this one.
+    The story is written to a temp file, which replaces saveas only if all the strings were found.
     '''
 
-    s = '\n%%%%%%%%%%%%%%%%%%% NEW CHAPTER %%%%%%%%%%%%%%%%%%%%%%%%\n\n'
-    story = '\n'.join([ open('header.tex').read()
-                      , *[s+t for t in texs]
-                      , open('footer.tex').read() 
-                      ])
-
-    # Verify that mm.tex is correct; certain fixed strings should appear in it.
+    missing = { exp.encode('utf-8') for exp in strs_should_be_present }
+    overlap = max(map(len, missing), default=1) - 1
+    tail = b''
+
+    def search(text):
+        pos = 0
+        while missing:
+            # Longest first, so a string that's a prefix of another one doesn't hide it.
+            regex = b'|'.join(map(re.escape, sorted(missing, key=len, reverse=True)))
+            m = re.compile(regex).search(text, pos)
+            if not m: break
+            missing.discard(m.group())
+            pos = m.start() # search again from here, in case another string overlaps this one
+
+    def check(piece):
+        nonlocal tail
+        search(tail + bytes(piece[:overlap]))
+        search(piece)
+        tail = (tail + bytes(piece[-overlap:]))[-overlap:] if overlap else b''
+
+    def text_file(path):
+        # Without any '\r', the bytes are the same as open(path).read().encode('utf-8').
+        data = chapter_bytes(path)
+        return data if data.obj.find(b'\r') < 0 else chapter_text(path)
+
+    s = f'\n{CHAPTER_BANNER}\n\n'
+    tmp = f'{saveas}.tmp'
+    with open(tmp,'wb') as f:
+        for piece in chain( [text_file(header)]
+                          , chain.from_iterable(('\n'+s, t) for t in texs)
+                          , ['\n', text_file(footer)]
+                          ):
+            if isinstance(piece, str): piece = piece.encode('utf-8')
+            f.write(piece)
+            check(piece)
 
-    strs_should_be_present = [
-        "bringing pistols into"
-      , "to explain how I got"
-      , "goodness of humanity"
-      , "he could actually"
-      , "--- that he"
-      , "bric‐a‐brac"
-      , "presumptions."
-    ]
     for exp in strs_should_be_present:
-        assert exp in story, f'UH OH: Expected string "{exp}" not found in final story "{tex_file}"!'
+        if exp.encode('utf-8') in missing: os.remove(tmp)
+        assert exp.encode('utf-8') not in missing, f'UH OH: Expected string "{exp}" not found in final story "{saveas}"!'
     print(f'Great! All test-strings were present in final story!')
 
-    open(saveas,'w').write(story)
-
+    os.replace(tmp, saveas)
+
+
+def file_checksums(files):
+    'MD5 of each file, or None if it doesnt exist.'
+    return { f: hashlib.md5(open(f,'rb').read()).hexdigest() if os.path.isfile(f) else None for f in files }
+
+# Reading pdflatex's log (eg mm.log).
+#
+# pdflatex runs in batchmode, so everything it has to say goes in the log: boxes it couldn't fit
+# on a line (eg "Overfull \hbox (12.3pt too wide) in paragraph at lines 865--866", like the
+# "pistols into your home" line FIX_TEX_FINAL_ONE_OFF_PROBLEMS fixes), references it couldn't resolve,
+# requests to run it again, and errors. parse_tex_log turns the log into one dict per warning, as it
+# reads it, and tex_log_chapters works out which chapter (and which line of its *_e_good.tex) each one is in.
+#
+# The log is wrapped at 79 characters, and says which file TeX is reading by printing "(" and the
+# file name when it opens one, and ")" when it's done with it. Overfull boxes are followed by the
+# text of the box, which can have any parentheses in it, so we skip that, like latexmk does.
+
+TEX_LOG_WIDTH = 79
+
+TEX_LOG_BOX = lazy_regex( r'(?P<kind>Overfull|Underfull) \\(?P<box>[hv])box '
+                          r'\((?:badness (?P<badness>\d+)|(?P<pt>[\d.]+)pt too \w+)\) '
+                          r'(?:.*? at lines? (?P<line>\d+)(?:--(?P<last_line>\d+))?)?' )
+TEX_LOG_WARNING = lazy_regex(r'(?:LaTeX|Package (?P<package>\S+)|Class (?P<cls>\S+)) Warning: (?P<message>.*)')
+TEX_LOG_INPUT_LINE = lazy_regex(r'on input line (\d+)')
+TEX_LOG_FILE = lazy_regex(r'\((?P<file>[^\s()]*)|\)')
+
+def tex_log_lines(lines, width=TEX_LOG_WIDTH):
+    'The lines of a TeX log, with the ones TeX broke at width characters joined back together.'
+    held = ''
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if len(line) == width:
+            held += line
+            continue
+        yield held + line
+        held = ''
+    if held:
+        yield held
+
+def parse_tex_log(lines):
+    '''
+    The warnings in a pdflatex log (eg open('mm.log', encoding='latin-1')), one dict at a time, each with:
+    kind ('overfull', 'underfull', 'undefined_reference', 'rerun', 'warning', or 'error'), message,
+    file (the file TeX was reading, as the log names it, eg ./mm.tex), and line (of that file), if the log says.
+    Boxes also have box ('h' or 'v'), and pt (how much too wide or high) or badness.
+    '''
+    files = []      # the files TeX has open (or None, for a "(" that isn't a file), innermost last
+    skip = False    # in the text of a box, or the context of an error, which run until a blank line
+    pending = None  # a package warning, which may go on for several lines
+    error = None    # an error, until we've seen which line it's on
+
+    def current_file():
+        return next((f for f in reversed(files) if f), None)
+
+    for line in tex_log_lines(lines):
+        if pending:
+            if line.startswith(f"({pending['package']})"):
+                pending['message'] += ' ' + line[len(pending['package'])+2:].strip()
+                continue
+            yield _tex_log_warning(pending)
+            pending = None
+        if skip:
+            if error and (m := re.match(r'l\.(\d+)', line)):
+                error['line'] = int(m.group(1))
+            if line.strip() == '':
+                skip = False
+                if error:
+                    yield error
+            continue
+        error = None
+
+        if m := TEX_LOG_BOX.match(line):
+            yield { 'kind': m.group('kind').lower(), 'message': line, 'file': current_file(), 'box': m.group('box')
+                  , **({ 'line': int(m.group('line')), 'last_line': int(m.group('last_line') or m.group('line')) } if m.group('line') else {})
+                  , **({ 'badness': int(m.group('badness')) } if m.group('badness') else { 'pt': float(m.group('pt')) })
+                  }
+            skip = True
+        elif m := TEX_LOG_WARNING.match(line):
+            pending = { 'package': m.group('package') or m.group('cls'), 'message': m.group('message'), 'file': current_file() }
+            if not pending['package']:
+                yield _tex_log_warning(pending)
+                pending = None
+        elif line.startswith('! '):
+            error = { 'kind': 'error', 'message': line[2:], 'file': current_file() }
+            skip = True
+        else:
+            for m in TEX_LOG_FILE.finditer(line):
+                if m.group() == ')':
+                    if files: files.pop()
+                else:
+                    files.append(m.group('file') if '.' in m.group('file') else None)
+    if pending:
+        yield _tex_log_warning(pending)
+    if skip and error:
+        yield error
+
+def _tex_log_warning(w):
+    # The kind of a LaTeX or package warning, and the line it's about (for parse_tex_log).
+    msg = w['message']
+    kind = ( 'rerun'               if re.search(r'Rerun|may have changed', msg) else
+             'undefined_reference' if re.search(r'(Reference|Citation) .* undefined', msg) else
+             'warning' )
+    m = TEX_LOG_INPUT_LINE.search(msg)
+    return { 'kind': kind, 'message': msg, 'file': w['file'], **({ 'line': int(m.group(1)) } if m else {}),
+             **({ 'package': w['package'] } if w['package'] else {}) }
+
+def tex_log_chapters(warnings, tex_file, chapters=None):
+    '''
+    Add to each of the warnings (from parse_tex_log) which chapter it's in, and the line of that chapter.
 
-def tex_to_pdf(tex_file, saveas):
+    In a draft (see tex_to_pdf_draft), each chapter is its own file (eg files/03_e_good.tex), so the
+    log says so directly. In mm.tex, the chapters come one after the other, each after a CHAPTER_BANNER line
+    (see make_final_tex): the k-th is chapters[k] (default: 'chapter k'), and anything before the first is in the header.
+    '''
+    starts = [] # the line of mm.tex each chapter starts on
+    with open(tex_file, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            if line.rstrip('\n') == CHAPTER_BANNER:
+                starts.append(n + 2) # after the banner, and a blank line
+    names = list(chapters) if chapters else [ f'chapter {k}' for k in range(1, len(starts)+1) ]
+
+    for w in warnings:
+        f, line = w.get('file'), w.get('line')
+        if f is None or line is None:
+            pass
+        elif os.path.normpath(f) != os.path.normpath(tex_file):
+            w['chapter'], w['chapter_line'] = os.path.normpath(f), line
+        elif not starts or line < starts[0]:
+            w['chapter'], w['chapter_line'] = 'header', line
+        else:
+            k = bisect.bisect_right(starts, line) - 1
+            w['chapter'], w['chapter_line'] = names[k] if k < len(names) else f'chapter {k+1}', line - starts[k] + 1
+    return warnings
+
+def tex_log_report(warnings, previous=None):
+    '''
+    The overfull boxes, undefined references, and errors among the warnings, one per line
+    (eg "files/08_e_good.tex:865: overfull \\hbox, 12.3pt too wide"), then how many of each kind there were,
+    and if given the warnings from before (eg the last build), how many there were then.
     '''
+    lines = []
+    for w in warnings:
+        if w['kind'] in ('overfull', 'undefined_reference', 'error'):
+            where = f"{w['chapter']}:{w['chapter_line']}" if 'chapter' in w else (w.get('file') or '?')
+            what = f"overfull \\{w['box']}box, {w['pt']}pt too {'wide' if w['box'] == 'h' else 'high'}" if w['kind'] == 'overfull' else f"{w['kind']}: {w['message']}"
+            lines.append(f'{where}: {what}')
+    counts = collections.Counter( w['kind'] for w in warnings )
+    before = collections.Counter( w['kind'] for w in previous or [] )
+    lines.append( 'pdflatex: ' + ', '.join( f'{counts[k]} {k}' + (f' (was {before[k]})' if previous is not None and before[k] != counts[k] else '')
+                                            for k in ['overfull', 'underfull', 'undefined_reference', 'rerun', 'warning', 'error'] ) )
+    return '\n'.join(lines)
+
+# Precompiled preamble
+#
+# Every pdflatex run starts by reading the preamble of mm.tex (everything in header.tex before \begin{document}):
+# memoir, hyperref, the fonts, extdash.sty, etc. Like mylatexformat, we have pdflatex read it once and dump
+# the state it's in afterwards as a "format" file, which later runs start from instead of from scratch.
+# When a run starts from the format, mylatexformat skips the preamble of the tex file up to \begin{document}
+# (or up to END_OF_DUMP, after which it reads the rest of the preamble as usual; see tex_to_pdf_draft).
+
+FORMAT_DIR = '.cache/formats'
+FORMAT_KEEP = 8 # how many formats to keep, eg for different headers in build-batch.py
+FORMAT_RETRY = 24 * 3600 # seconds after a format fails before trying to make it again (eg after installing mylatexformat)
+END_OF_DUMP = r'\csname endofdump\endcsname'
+TEX_USES = lazy_regex(r'\\(?:documentclass|usepackage|RequirePackage)\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}')
+
+def tex_preamble(tex_file):
+    r'''
+    The preamble of the given tex file, ie everything before \begin{document} (or END_OF_DUMP, if that comes first).
+    Only reads as far as that, not the whole file.
+    '''
+    preamble = []
+    with open(tex_file, encoding='utf-8') as f:
+        for line in f:
+            ends = [ i for i in (line.find(r'\begin{document}'), line.find(END_OF_DUMP)) if i >= 0 ]
+            if ends:
+                preamble.append(line[:min(ends)])
+                break
+            preamble.append(line)
+    return ''.join(preamble)
+
+@lru_cache
+def pdflatex_version():
+    'The first line of "pdflatex --version": a format only works with the pdflatex that made it.'
+    return subprocess.run(['pdflatex', '--version'], capture_output=True, text=True).stdout.split('\n')[0]
+
+@traced
+def preamble_format(tex_file, format_dir=FORMAT_DIR):
+    r'''
+    Step G, part 1: Dump the preamble of the given tex file into a pdflatex format in format_dir (see above),
+    unless there's one already, and return its name, to give to pdflatex as -fmt=<name>
+    (with format_dir on the TEXFORMATS path; see tex_to_pdf).
+
+    The name is a hash of the preamble, any local packages it uses (eg extdash.sty), and the pdflatex version,
+    so changing any of those makes a new format. If pdflatex can't dump the preamble (eg mylatexformat
+    isn't installed), it returns None, and we typeset without a format, as before. It leaves a <name>.failed
+    file behind, so for the next FORMAT_RETRY seconds it doesn't try again (and fail again) for that preamble.
+    '''
+    preamble = tex_preamble(tex_file)
+    h = hashlib.sha256(pdflatex_version().encode('utf-8'))
+    h.update(preamble.encode('utf-8'))
+    for names in TEX_USES.findall(preamble):
+        for f in [ n.strip() + ext for n in names.split(',') for ext in ('.sty', '.cls') ]:
+            if os.path.isfile(f):
+                h.update(f.encode('utf-8'))
+                h.update(open(f, 'rb').read())
+    name = f'preamble-{h.hexdigest()[:16]}'
+    fmt = f'{format_dir}/{name}.fmt'
+
+    if os.path.isfile(fmt):
+        os.utime(fmt) # see below
+        return name
+    failed = f'{format_dir}/{name}.failed'
+    if os.path.isfile(failed):
+        if time.time() - os.stat(failed).st_mtime < FORMAT_RETRY:
+            return None
+        os.remove(failed)
+
+    # Under a temp name first, since eg build-batch.py may be typesetting several books with the same header at once.
+    os.makedirs(format_dir, exist_ok=True)
+    tmp = f'{name}.{os.getpid()}'
+    p = subprocess.run(
+        [ 'pdflatex'
+        , '-ini'
+        , '-interaction=batchmode'
+        , f'-jobname={tmp}'
+        , f'-output-directory={format_dir}'
+        , '&pdflatex'
+        , 'mylatexformat.ltx'
+        , tex_file
+        ]
+        , capture_output=True
+        , text=True
+    )
+    if p.returncode or not os.path.isfile(f'{format_dir}/{tmp}.fmt'):
+        print(f'preamble_format: pdflatex could not dump the preamble of {tex_file} (see {format_dir}/{tmp}.log), so typesetting without it.')
+        open(f'{format_dir}/{name}.failed', 'w').close()
+        return None
+    os.replace(f'{format_dir}/{tmp}.fmt', fmt)
+    os.replace(f'{format_dir}/{tmp}.log', f'{format_dir}/{name}.log')
+    print(f'preamble_format: dumped the preamble of {tex_file} into {fmt}')
+
+    # Each format is a few MB, so only keep the most recently used ones.
+    fmts = sorted( (f for f in os.listdir(format_dir) if f.endswith('.fmt')),
+                   key=lambda f: os.stat(f'{format_dir}/{f}').st_mtime, reverse=True )
+    for f in fmts[FORMAT_KEEP:]:
+        os.remove(f'{format_dir}/{f}')
+    return name
+
+@traced
+def tex_to_pdf(tex_file, saveas, max_runs=5, aux_files=(), chapters=None, fmt=True):
+    r'''
     Step G: Given a complete tex file, use pdflatex to convert it into the final PDF, saving the PDF under the given name.
 
+    pdflatex writes the table of contents etc into mm.aux, mm.toc, and mm.out, but only reads them
+    on the NEXT run. So (like latexmk) we keep re-running pdflatex until those files stop changing,
+    up to max_runs times. A fresh build takes 2 runs, but if the files from the last build are
+    still around and the TOC hasn't changed (eg, after fixing a typo), 1 run is enough.
+    aux_files lists any other files to watch, like the .aux files of \include'd chapters.
+    We also re-run it if its log (see parse_tex_log) says to, eg "Label(s) may have changed".
+
+    After the last run, we print the overfull boxes, undefined references, and errors in the log,
+    saying which chapter (and line of it) each is in (chapters: see tex_log_chapters), and how many
+    warnings of each kind there were, compared to the last build. The warnings are saved in eg mm.warnings.json.
+
+    Unless fmt=False, each run starts from a precompiled preamble (see preamble_format), rather than
+    reading header.tex's packages etc from scratch. The PDF is meant to come out the same either way.
+    If a run fails from the format, it's run again without it (which doesn't count towards max_runs),
+    and if that works, the format isn't used again for a while (see preamble_format).
+
     Note: Would've liked to be consistent with the other functions and 
     have this function take a string, and I can't figure out how to make pdflatex run from stdin
     without producing weird little error messages: "Please type a command or say 'end'". See:
     https://tex.stackexchange.com/questions/614919/passing-stdin-to-pdflatex-gives-please-type-a-command-or-say-end
     '''
 
-    # For TOC generation, gotta run twice.
-    for i in [1,2]:
-        p = subprocess.run(
-            [ 
-            'pdflatex'
-            , '-interaction=batchmode'
-            , f'-jobname={saveas[:-4]}' # no file extension
-            , tex_file
-            ]
-            , capture_output=True
-            , text=True
-            , check=True
-        )
+    job = saveas[:-4] # no file extension
+    watch = [ f'{job}.aux', f'{job}.toc', f'{job}.out', *aux_files ]
+    before = file_checksums(watch)
+    fmt = preamble_format(tex_file) if fmt else None
+
+    def run(i, fmt):
+        with trace_span('pdflatex', f'{os.path.basename(job)} run #{i}', bytes_in=data_size(tex_file), fmt=fmt) as span:
+            p = subprocess.run(
+                [ 
+                'pdflatex'
+                , *( [f'-fmt={fmt}'] if fmt else [] )
+                , '-interaction=batchmode'
+                , f'-jobname={job}'
+                , tex_file
+                ]
+                , capture_output=True
+                , text=True
+                , env={ **os.environ, 'TEXFORMATS': FORMAT_DIR + ':' } # the trailing ':' means "then the usual places"
+            )
+            span['bytes_out'] = data_size(saveas) if os.path.isfile(saveas) else None
+            warnings = []
+            if os.path.isfile(f'{job}.log'):
+                with open(f'{job}.log', encoding='latin-1') as log: # TeX writes bytes, not necessarily UTF-8
+                    warnings = list(parse_tex_log(log))
+            span['warnings'] = len(warnings)
+        print(f'pdflatex run #{i}: returncode {p.returncode}, {len(warnings)} warnings in {job}.log')
+        return p, warnings
+
+    for i in range(1, max_runs+1):
+        p, warnings = run(i, fmt)
+        if p.returncode and fmt:
+            print(f'pdflatex: failed starting from the precompiled preamble {fmt}, so trying again without it.')
+            bad_fmt, fmt = fmt, None
+            p, warnings = run(i, fmt)
+            if not p.returncode:
+                # It was the format's fault, so don't use it again (for a while).
+                os.makedirs(FORMAT_DIR, exist_ok=True)
+                open(f'{FORMAT_DIR}/{bad_fmt}.failed', 'w').close()
+                if os.path.isfile(f'{FORMAT_DIR}/{bad_fmt}.fmt'): os.remove(f'{FORMAT_DIR}/{bad_fmt}.fmt')
+        if p.returncode:
+            print(f'stdout: "{p.stdout}"')
+            print(f'stderr: "{p.stderr}"')
+            print(tex_log_report(tex_log_chapters([ w for w in warnings if w['kind'] == 'error' ], tex_file, chapters)))
+            raise subprocess.CalledProcessError(p.returncode, p.args, p.stdout, p.stderr)
+
+        after = file_checksums(watch)
+        rerun = [ w['message'] for w in warnings if w['kind'] == 'rerun' ]
+        if after == before and not rerun:
+            print(f'pdflatex: .aux/.toc/.out files unchanged after run #{i}, done.')
+            break
+        if rerun:
+            print(f'pdflatex: the log says "{rerun[0]}"')
+        before = after
+    else:
+        print(f'pdflatex: WARNING: .aux/.toc/.out files still changing after {max_runs} runs!')
+
+    record = f'{job}.warnings.json'
+    previous = json.load(open(record)) if os.path.isfile(record) else None
+    warnings = tex_log_chapters(warnings, tex_file, chapters)
+    print(tex_log_report(warnings, previous))
+    with open(record, 'w') as f:
+        json.dump(warnings, f, indent=1)
+
+
+@traced
+def tex_to_pdf_draft(chapter_files, saveas='mm-draft.pdf', only=None):
+    r'''
+    Step G, draft version: Quickly typeset just some of the chapters (eg the ones you're editing),
+    into a separate PDF (default mm-draft.pdf).
+
+    Rather than the whole story, mm-draft.tex \include's each of the chapter_files
+    (eg files/03_e_good.tex), and tells LaTeX to \includeonly the chapters in `only`.
+    The other chapters are skipped, but their page numbers and TOC entries are still right,
+    because LaTeX remembers them in each chapter's .aux file (eg files/03_e_good.aux) from
+    the last time it was typeset.
+
+    By default, `only` is the chapters whose TeX changed since the last draft build,
+    according to the checksums saved in mm-draft.chapters.json.
+    '''
+
+    job = saveas[:-4]
+    record = f'{job}.chapters.json'
+    old = json.load(open(record)) if os.path.isfile(record) else {}
+    new = file_checksums(chapter_files)
+    if only is None:
+        only = [ f for f in chapter_files if new[f] != old.get(f) ]
+    if not only:
+        print(f'tex_to_pdf_draft: no chapters changed since the last draft, nothing to do.')
+        return
+
+    print(f'tex_to_pdf_draft: typesetting {", ".join(only)}')
+
+    # \include and \includeonly take file names without the .tex, and \includeonly
+    # has to go in the preamble, ie, before \begin{document} in header.tex.
+    # It goes after END_OF_DUMP, so the rest of the preamble is the same as mm.tex's, and so is its format (see preamble_format).
+    names = [ f[:-4] for f in chapter_files ]
+    header = open('header.tex').read().replace(
+          r'\begin{document}'
+        , END_OF_DUMP + '\n' + r'\includeonly{' + ','.join(f[:-4] for f in only) + '}\n' + r'\begin{document}'
+        , 1 )
+    open(f'{job}.tex','w').write(
+        '\n'.join([ header
+                  , *[ f'\\include{{{n}}}' for n in names ]
+                  , open('footer.tex').read()
+                  ])
+    )
+
+    tex_to_pdf(f'{job}.tex', saveas, aux_files=[f'{n}.aux' for n in names])
+
+    json.dump({ **old, **{f: new[f] for f in only} }, open(record,'w'), indent=2)
+
+
+# Manifest: which chapters a change to lib.py actually changed, at which step.
+#
+# book_manifest hashes every chapter's output of every step (a thru e), then each chapter as a whole
+# (a hash of its 5 hashes), and at the top, one 'root' hash of those and of mm.tex, like a Merkle tree.
+# Comparing two manifests (see manifest_diff) starts at the root, and only looks inside the chapters
+# whose hash changed, so it says exactly where a change to eg FIX_HTML_TYPOS showed up,
+# without typesetting anything or diffing mm.tex and mm.pdf by eye.
+# Each build saves its manifest in mm.manifest.json (see typeset_if_changed).
+
+MANIFEST_STEPS = { 'a': 'orig.html', 'b': 'pruned.html', 'c': 'fix.html', 'd': 'pandoc.tex', 'e': 'good.tex' }
+
+def file_hash(path):
+    'SHA-256 of the file, or None if it doesn\'t exist.'
+    if not os.path.isfile(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def text_file_hash(path):
+    '''
+    text_hash of the file's text, as the steps see it (eg open(path).read(), with any '\\r\\n' turned into '\\n',
+    like in the downloaded *_a_orig.html files), or None if it doesn't exist. Only decodes it if it has a '\\r'.
+    '''
+    if not os.path.isfile(path):
+        return None
+    data = chapter_bytes(path)
+    if data.obj.find(b'\r') < 0:
+        return hashlib.sha256(data).hexdigest()
+    return text_hash(chapter_text(path))
+
+def merkle(hashes):
+    'One hash for a list of hashes (a node of the manifest\'s tree).'
+    return hashlib.sha256('\n'.join(map(str, hashes)).encode('utf-8')).hexdigest()
+
+def book_manifest(chapter_nums, tex_file='mm.tex', files_dir='files', pack=None, steps='abcde'):
+    '''
+    The manifest of the book (see above):
+        { 'root': ..., 'tex': <hash of tex_file>, 'chapters': { '01': { 'a': ..., ..., 'e': ..., 'chapter': ... }, ... } }
+    The hashes are of the text of each step's output (see text_file_hash), so they're the same with pack,
+    where they're taken from the chapter archive, whose index already has them.
+    Only hashes the given steps (eg 'e', for build.py --keep e); the others are None, and manifest_diff skips them.
+    '''
+    index = pack_index(pack) if pack else {}
+    chapters = {}
+    for i in chapter_nums:
+        c = {}
+        for step, name in MANIFEST_STEPS.items():
+            entry = f'{i:02}_{step}_{name}'
+            c[step] = ( None if step not in steps else
+                        index[entry]['sha256'] if entry in index else text_file_hash(f'{files_dir}/{entry}') )
+        c['chapter'] = merkle(c.values())
+        chapters[f'{i:02}'] = c
+    tex = file_hash(tex_file) if tex_file else None
+    return { 'root': merkle([ tex, *(c['chapter'] for c in chapters.values()) ]), 'tex': tex, 'chapters': chapters }
+
+def manifest_diff(golden, manifest):
+    '''
+    Where manifest differs from golden (eg a manifest saved before a change), one line per chapter:
+    the first step whose output changed, and the later ones that changed with it, eg
+    "chapter 05: changed at step c (05_c_fix.html), then d, e". Empty if they're the same.
+    '''
+    if golden['root'] == manifest['root']:
+        return []
+    lines = []
+    for k in sorted(golden['chapters'].keys() | manifest['chapters'].keys()):
+        old, new = golden['chapters'].get(k), manifest['chapters'].get(k)
+        if old is None or new is None:
+            lines.append(f'chapter {k}: ' + ('not in the golden manifest' if old is None else 'missing'))
+        elif old['chapter'] != new['chapter']:
+            changed = [ step for step in MANIFEST_STEPS if old[step] and new[step] and old[step] != new[step] ]
+            if not changed:
+                continue # only steps that one of them didn't hash
+            lines.append( f'chapter {k}: changed at step {changed[0]} ({k}_{changed[0]}_{MANIFEST_STEPS[changed[0]]})'
+                          + (f', then {", ".join(changed[1:])}' if changed[1:] else '') )
+    if golden['tex'] and manifest['tex'] and golden['tex'] != manifest['tex']: # (drafts don't have it)
+        lines.append('the book\'s TeX changed' + ('' if lines else ' (but no chapter did: header.tex, footer.tex, or make_final_tex?)'))
+    return lines
+
+def typeset_if_changed(tex_file, saveas, manifest, record=None, **kwargs):
+    '''
+    Step G, but only if need be: tex_to_pdf(tex_file, saveas, **kwargs), unless tex_file is exactly what saveas
+    was typeset from last time, according to the manifest saved in record (default: eg mm.manifest.json).
+    Then save manifest (from book_manifest) in record, with the hash of the PDF.
+
+    This goes by the 'tex' hash, not the root, since eg a change to fix_html that fix_tex
+    happens to undo changes the root, but not the PDF.
+    '''
+    record = record or f'{saveas[:-4]}.manifest.json'
+    old = json.load(open(record)) if os.path.isfile(record) else {}
+    pdf = file_hash(saveas)
+    if manifest['tex'] and old.get('tex') == manifest['tex'] and pdf and old.get('pdf') == pdf:
+        print(f'typeset_if_changed: {tex_file} is the same as when {saveas} was typeset (see {record}), so not running pdflatex.')
+    else:
+        tex_to_pdf(tex_file, saveas, **kwargs)
+        pdf = file_hash(saveas)
+    write_atomically(record, json.dumps({ **manifest, 'pdf': pdf }, indent=1))
+
+
+# Cover art: the images in cover-art/, sized for where they're going.
+#
+# The cover art (front, spine, and back) is uploaded to lulu.com separately from mm.pdf (see the README).
+# The PNGs are a few MB each, with an alpha channel they don't use, so prepare_covers makes a copy of each
+# for each of COVER_PROFILES: at most that many dots per inch (they're never scaled up), in that format.
+# It also puts them side by side into one whole-cover image (back, spine, front), in the same format, for printers that want that.
+# The resized images are cached in COVER_CACHE_DIR by a hash of the source image, the profile, and the code,
+# as is the whole cover, so after the first time, preparing them is mostly copying.
+
+COVER_PIECES = [ 'cover-art/MM_back.png', 'cover-art/MM_spine.png', 'cover-art/MM_front.png' ] # left to right
+COVER_HEIGHT_IN = 9.25 # a 6"x9" paperback, plus 1/8" of bleed at the top and bottom
+COVER_PROFILES = { 'print'  : { 'dpi': 300, 'format': 'PNG',  'mode': 'RGB' }
+                 , 'screen' : { 'dpi': 96,  'format': 'JPEG', 'mode': 'RGB', 'quality': 85 }
+                 , 'ereader': { 'dpi': 150, 'format': 'JPEG', 'mode': 'L',   'quality': 80 } # e-ink is grayscale
+                 }
+COVER_EXTS = { 'PNG': 'png', 'JPEG': 'jpg' } # the file extension for each format
+COVER_CACHE_DIR = '.cache/covers'
+
+def cover_height(pieces, profile):
+    'The height in pixels of the pieces for the given profile: its dpi, but no taller than the shortest piece.'
+    from PIL import Image
+    heights = []
+    for f in pieces:
+        with Image.open(f) as im: # only reads its header
+            heights.append(im.height)
+    return min( round(COVER_PROFILES[profile]['dpi'] * COVER_HEIGHT_IN), *heights )
+
+def _cover_image(src, height, mode):
+    'The image src, flattened onto white, in the given mode (eg \'L\' for grayscale), scaled to the given height.'
+    from PIL import Image
+    with Image.open(src) as im:
+        if im.mode in ('RGBA', 'LA', 'P'):
+            im = im.convert('RGBA')
+            im = Image.alpha_composite(Image.new('RGBA', im.size, 'white'), im) # as if printed on white paper
+        im = im.convert(mode) # a copy, so the file can be closed
+    if im.height != height:
+        # reducing_gap: shrink by a whole factor first (fast), then resample the rest (good).
+        im = im.resize((round(im.width * height / im.height), height), Image.LANCZOS, reducing_gap=3.0)
+    return im
+
+def _cover_cached_file(srcs, height, profile, *funcs):
+    'Where the output of funcs on srcs for the given height and profile is cached: a hash of all of them (see above).'
+    import inspect
+    p = COVER_PROFILES[profile]
+    h = hashlib.sha256()
+    for src in srcs:
+        with open(src, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    h.update(json.dumps([ height, p, COVER_HEIGHT_IN ], sort_keys=True).encode('utf-8'))
+    for f in [ _cover_image, *funcs ]:
+        h.update(inspect.getsource(f).encode('utf-8'))
+    return f'{COVER_CACHE_DIR}/{h.hexdigest()[:16]}.{p["format"].lower()}'
+
+def _save_cover(im, cached_file, profile):
+    'Save im to cached_file in the format of the given profile, with its dpi recorded in it.'
+    p = COVER_PROFILES[profile]
+    dpi = im.height / COVER_HEIGHT_IN
+    os.makedirs(COVER_CACHE_DIR, exist_ok=True)
+    tmp = f'{cached_file}.{os.getpid()}.tmp'
+    if p['format'] == 'JPEG':
+        im.save(tmp, 'JPEG', quality=p['quality'], optimize=True, progressive=True, dpi=(dpi, dpi))
+    else:
+        im.save(tmp, 'PNG', optimize=True, dpi=(dpi, dpi))
+    os.replace(tmp, cached_file)
 
-        print(f'pdflatex run #{i}:')
-        print(f'returncode: "{p.returncode}"')
-        print(f'stdout: "{p.stdout}"')
-        print(f'stderr: "{p.stderr}"')
+@traced
+def resize_cover(src, saveas, height, profile):
+    '''
+    Step H: Scale the image src (eg cover-art/MM_front.png) to the given height (keeping its shape), and save it
+    in the format of the given profile (see COVER_PROFILES), eg as a grayscale JPEG, with its dpi recorded in it.
+    Cached in COVER_CACHE_DIR (see above).
+    '''
+    cached_file = _cover_cached_file([src], height, profile, resize_cover, _save_cover)
+    if os.path.isfile(cached_file):
+        print(f'resize_cover: cache hit for {src} ({profile})')
+    else:
+        _save_cover(_cover_image(src, height, COVER_PROFILES[profile]['mode']), cached_file, profile)
+    os.makedirs(os.path.dirname(saveas) or '.', exist_ok=True)
+    shutil.copyfile(cached_file, saveas)
 
+@traced
+def whole_cover(pieces, saveas, height, profile):
+    '''
+    Step H, part 2: Scale the images in pieces (eg COVER_PIECES) to the given height, like resize_cover,
+    and put them side by side, left to right, into one image in the format of the given profile.
+    It starts from the original images, rather than resize_cover's, so a JPEG isn't compressed twice.
+    The whole image is made in memory (about 100 MB for print), then saved like resize_cover's.
+    Cached in COVER_CACHE_DIR, like resize_cover.
+    '''
+    cached_file = _cover_cached_file(pieces, height, profile, whole_cover, _save_cover)
+    if os.path.isfile(cached_file):
+        print(f'whole_cover: cache hit for {saveas}')
+    else:
+        from PIL import Image
+        mode = COVER_PROFILES[profile]['mode']
+        ims = [ _cover_image(f, height, mode) for f in pieces ]
+        whole = Image.new(mode, (sum( im.width for im in ims ), height))
+        x = 0
+        for im in ims:
+            whole.paste(im, (x, 0))
+            x += im.width
+        _save_cover(whole, cached_file, profile)
+    os.makedirs(os.path.dirname(saveas) or '.', exist_ok=True)
+    shutil.copyfile(cached_file, saveas)
+
+def prepare_covers(profiles=COVER_PROFILES, out_dir='assets', pieces=COVER_PIECES):
+    '''
+    Step H: For each of the profiles (names in COVER_PROFILES), save each of the cover pieces sized for it,
+    and the whole cover, in out_dir/<profile>/, eg assets/print/MM_front.png and assets/print/whole-cover.png
+    (or assets/screen/MM_front.jpg and assets/screen/whole-cover.jpg).
+    '''
+    for profile in profiles:
+        height = cover_height(pieces, profile)
+        ext = COVER_EXTS[COVER_PROFILES[profile]['format']]
+        outs = [ f'{out_dir}/{profile}/{os.path.splitext(os.path.basename(f))[0]}.{ext}' for f in pieces ]
+        for f, out in zip(pieces, outs):
+            resize_cover(f, out, height, profile)
+        whole = f'{out_dir}/{profile}/whole-cover.{ext}'
+        whole_cover(pieces, whole, height, profile)
+        print(f'prepare_covers: {profile}: ' + ', '.join( f'{os.path.basename(out)} {os.path.getsize(out)/1e6:.2f} MB' for out in [*outs, whole] ))
+
+
+# Content-addressed cache for steps B thru E.
+#
+# The output of prune_html, fix_html, html_to_tex, and fix_tex depends only on
+# their input text and on the code/rules/programs they use. So we save each
+# output in CACHE_DIR under a hash of all those things, and next time the same
+# input comes along (eg after switching git branches, which changes the mtimes
+# but not the contents), we can skip the work. Files that haven't been used in
+# a while are deleted once the cache grows past CACHE_MAX_BYTES (see cache_evict).
+#
+# Several processes (build.py --jobs, doit's workers) share the cache, so any entry may be deleted
+# by another process at any moment: a missing entry is just a cache miss.
+
+CACHE_DIR = '.cache/stages'
+CACHE_MAX_BYTES = 100_000_000
+CACHE_STALE_TMP = 3600 # seconds: a *.tmp file older than this was left by a writer that died
+
+_cache_bytes = {} # cache_dir -> about how many bytes are in it, as far as this process knows (see cache_put)
+
+@lru_cache
+def pandoc_version():
+    return subprocess.run(['pandoc', '--version'], capture_output=True, text=True, check=True).stdout
+
+def stage_config(stage):
+    '''
+    Everything besides the input text that affects the output of a stage:
+    its source code, its helpers and rule tables, and for html_to_tex, the pandoc version.
+    '''
+    import inspect
+    return [ inspect.getsource(stage)
+           , *{ 'prune_html' : lambda: [ PRUNE_HTML_PARSERS, storytext_serializer, chapter_name_from_title ]
+              , 'fix_html'   : lambda: [ FIX_HTML_TYPOS, FIX_HTML_RULES, compile_rules, apply_rules ]
+              , 'html_to_tex': lambda: [ PANDOC_CMD, pandoc_version() ]
+              , 'fix_tex'    : lambda: [ FIX_TEX_SMARTQUOTES, FIX_TEX_NEWLINES, FIX_TEX_FINAL_ONE_OFF_PROBLEMS, compile_rules, apply_rules ]
+              }.get(stage.__name__, list)()
+           ]
+
+def stage_version(stage):
+    'A hash of stage_config(stage): it changes whenever the stage\'s code, rules, or (for pandoc) version do.'
+    import inspect
+    config = json.dumps(stage_config(stage), default=inspect.getsource)
+    return hashlib.sha256(f'{stage.__name__}\0{config}'.encode('utf-8')).hexdigest()[:16]
+
+def cache_key(stage, x):
+    # Functions and classes in the config (eg fix_html_hyphens) are keyed by their source code.
+    import inspect
+    config = json.dumps(stage_config(stage), default=inspect.getsource)
+    h = hashlib.sha256()
+    for part in [stage.__name__, config, x]:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def cache_get(key, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, key)
+    try:
+        with open(path, encoding='utf-8', newline='') as f:
+            out = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path) # mark as recently used
+    except FileNotFoundError:
+        pass # evicted by another process since we read it
+    return out
+
+def cache_evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    '''
+    If the cache is over max_bytes, delete the least-recently-used entries until it's under 90% of that
+    (so the next few puts don't have to evict again). Also deletes *.tmp files left behind by writers
+    that died. Returns about how many bytes are left.
+    '''
+    now = time.time()
+    entries = []
+    for e in os.scandir(cache_dir):
+        try:
+            st = e.stat()
+            if e.name.endswith('.tmp'):
+                if st.st_mtime < now - CACHE_STALE_TMP:
+                    os.remove(e.path)
+                continue
+        except FileNotFoundError: # deleted by another process
+            continue
+        entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    if total > max_bytes:
+        for _, size, p in sorted(entries):
+            if total <= max_bytes * 0.9: break
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            total -= size
+    return total
+
+def cache_put(key, out, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key)
+    tmp = f'{path}.{os.getpid()}.tmp' # write-then-rename, so readers never see half a file
+    with open(tmp, 'w', encoding='utf-8', newline='') as f:
+        f.write(out)
+        size = f.tell()
+    os.replace(tmp, path)
+
+    # Rather than adding up the whole cache every time, keep a running total, and only look at
+    # the whole cache (see cache_evict) the first time, and when the total goes over the limit.
+    total = _cache_bytes.get(cache_dir)
+    total = cache_evict(cache_dir, max_bytes) if total is None else total + size
+    if total > max_bytes:
+        total = cache_evict(cache_dir, max_bytes)
+    _cache_bytes[cache_dir] = total
+
+def cached(stage, x, saveas=None):
+    '''
+    Like stage(x, saveas=saveas), but reuse the stage's output if we've seen this input before.
+    '''
+    key = cache_key(stage, x)
+    out = cache_get(key)
+    if out is None:
+        _trace.cache = 'miss'
+        try:
+            out = stage(x, saveas=saveas)
+        finally:
+            _trace.cache = None
+        cache_put(key, out)
+    else:
+        with trace_span(stage.__name__, trace_label(x, saveas), bytes_in=data_size(x), bytes_out=data_size(out), cache='hit'):
+            print(f'{stage.__name__}: cache hit {key[:12]}')
+            if saveas: save(saveas, out)
+    return out
+
+def cached_batch(stage, batch_stage, xs, saveas=None):
+    '''
+    Like cached(), but for a list of inputs: look each one up in the cache under
+    the key for stage, and run batch_stage once on just the ones that missed.
+    (Eg stage=html_to_tex, batch_stage=html_to_tex_batch.)
+    '''
+    xs = list(xs)
+    saveas = saveas or [None]*len(xs)
+    keys = [ cache_key(stage, x) for x in xs ]
+    outs = [ cache_get(k) for k in keys ]
+
+    for x, k, out, f in zip(xs, keys, outs, saveas):
+        if out is not None:
+            with trace_span(stage.__name__, trace_label(x, f), bytes_in=data_size(x), bytes_out=data_size(out), cache='hit'):
+                print(f'{stage.__name__}: cache hit {k[:12]}')
+                if f: save(f, out)
+
+    misses = [ j for j, out in enumerate(outs) if out is None ]
+    if misses:
+        _trace.cache = 'miss'
+        try:
+            batch_outs = batch_stage([xs[j] for j in misses], saveas=[saveas[j] for j in misses])
+        finally:
+            _trace.cache = None
+        for j, out in zip(misses, batch_outs):
+            cache_put(keys[j], out)
+            outs[j] = out
+    return outs
+
+async def cached_async(stage, async_stage, x, saveas=None):
+    '''
+    Like cached(), but on a miss, awaits async_stage(x) instead of running stage
+    (eg stage=html_to_tex, async_stage=html_to_tex_async). The cache is still keyed by stage.
+    '''
+    key = cache_key(stage, x)
+    out = cache_get(key)
+    if out is None:
+        _trace.cache = 'miss'
+        try:
+            out = await async_stage(x, saveas=saveas)
+        finally:
+            _trace.cache = None
+        cache_put(key, out)
+    else:
+        with trace_span(stage.__name__, trace_label(x, saveas), bytes_in=data_size(x), bytes_out=data_size(out), cache='hit'):
+            print(f'{stage.__name__}: cache hit {key[:12]}')
+            if saveas: save(saveas, out)
+    return out
+
+
+# Running one chapter through steps A thru E, for build.py and build-batch.py.
+
+def funcs_for_chapter(i, cache=True, files_dir='files', keep='abcde', pack=None):
+    '''
+    Steps A thru E for chapter i, as a list of functions, each taking the previous one's output.
+    keep: which steps' outputs to save in files_dir (eg 'e' saves only *_e_good.tex).
+    pack: instead, save all of them in this chapter archive (see packed), and skip the steps that are up to date in it.
+    '''
+    run = cached if cache else lambda stage, x, saveas: stage(x, saveas=saveas)
+    f = lambda step, name: f'{files_dir}/{i:02}_{step}_{name}' if step in keep else None
+    get = download
+    if pack:
+        f = lambda step, name: f'{i:02}_{step}_{name}' # the entry's name
+        run_step = run
+        run = lambda stage, x, saveas: packed(stage, x, pack, saveas, run=lambda stage, x: run_step(stage, x, None))
+        get = lambda x, saveas: packed(download, x, pack, saveas, reuse=False)
+    return [ lambda x: get(              x, saveas=f('a', 'orig.html') )
+           , lambda x: run( prune_html,  x, saveas=f('b', 'pruned.html') )
+           , lambda x: run( fix_html,    x, saveas=f('c', 'fix.html') )
+           , lambda x: run( html_to_tex, x, saveas=f('d', 'pandoc.tex') )
+           , lambda x: run( fix_tex,     x, saveas=f('e', 'good.tex') )
+           ]
+
+def build_chapter(i, first=0, last=5, x=None, cache=True, files_dir='files', keep='abcde', background=False, pack=None):
+    '''
+    Run steps funcs_for_chapter(i)[first:last], starting from x (default: the chapter's URL).
+    With background=True, the files are written in the background while the next steps run
+    (see background_writes), and are all written by the time this returns.
+    A top-level function (not a lambda) so a process pool can pickle it.
+    '''
+    if background: background_writes()
+    try:
+        return reduce( lambda x,f: f(x)
+                     , funcs_for_chapter(i, cache, files_dir, keep, pack)[first:last]
+                     , url_for_chapter(i, cached=True, files_dir=files_dir) if x is None else x
+                     )
+    finally:
+        flush_writes()
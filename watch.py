@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# watch.py: Keep mm.pdf up to date while you edit lib.py, header.tex, footer.tex, or the chapters in files/.
+#
+# Run it by typing "python3 watch.py" at your terminal (no quotes), and leave it running.
+# Every time you save one of those files, it re-builds just what changed, and re-typesets the PDF.
+# To typeset only the chapters that changed, into mm-draft.pdf (see lib.tex_to_pdf_draft), add "--draft".
+# Type Ctrl-C to stop it.
+#
+# Unlike doit or build.py, it doesn't start from scratch each time: it keeps every chapter's output of
+# steps B thru E in memory, and works out which chapters a change actually affects:
+#
+#   - If you change a chapter's web page (files/NN_a_orig.html), just that chapter is re-built.
+#   - If you change lib.py (eg add a typo to FIX_HTML_TYPOS), it re-loads lib.py and re-runs the Python steps
+#     (prune_html, fix_html, fix_tex: a fraction of a second for all the chapters) on every chapter.
+#     But pandoc, which is the slow part, is only run on the chapters whose HTML came out different
+#     (eg, the ones containing the typo), or on all of them if html_to_tex or its pandoc options changed.
+#   - Only the intermediate files whose contents changed get re-written.
+#   - If no chapter's TeX came out different (and header.tex and footer.tex didn't change), the PDF is left alone.
+#   - Before typesetting, the chapters' TeX is checked for likely problems, like unbalanced braces (see lib.lint_tex),
+#     and if there are errors, it says so, rather than waiting for pdflatex to fail. To typeset anyway, add "--no-lint".
+#
+# If a step fails (eg you saved lib.py half-way through an edit), it prints the error and waits for the next change.
+
+import lib
+
+import argparse
+import importlib
+import inspect
+import json
+import os
+import time
+import traceback
+
+CHAPTER_NUMS = range(1, lib.chapter_count(open(lib.url_for_chapter(1, cached=True)).read()) + 1)
+
+# Steps B thru E: the letter, file name, and lib function of each.
+STEPS = [ ('b', 'pruned.html', 'prune_html')
+        , ('c', 'fix.html',    'fix_html')
+        , ('d', 'pandoc.tex',  'html_to_tex')
+        , ('e', 'good.tex',    'fix_tex')
+        ]
+
+def chapter_file(i, step, name):
+    return f'files/{i:02}_{step}_{name}'
+
+def watched_files():
+    return [ 'lib.py', 'header.tex', 'footer.tex', *[ chapter_file(i, 'a', 'orig.html') for i in CHAPTER_NUMS ] ]
+
+def mtimes():
+    return { f: os.stat(f).st_mtime_ns if os.path.exists(f) else None for f in watched_files() }
+
+def pandoc_config():
+    'Everything besides its input that affects the output of html_to_tex (see lib.stage_config).'
+    return json.dumps(lib.stage_config(lib.html_to_tex), default=inspect.getsource)
+
+def update_chapter(i, outs, pandoc_changed):
+    '''
+    Re-run steps B thru E on chapter i, whose outputs from last time are in outs (a dict
+    from step letter to text, updated in place), saving the ones that came out different.
+    Returns the letters of those steps.
+
+    pandoc is slow, so unless pandoc_changed, html_to_tex is only re-run if its input changed.
+    Even then, it goes through lib.cached, so eg undoing a change doesn't need pandoc either.
+    '''
+    changed = []
+    x = lib.download(lib.url_for_chapter(i, cached=True))
+    for step, name, stage in STEPS:
+        if stage == 'html_to_tex':
+            if pandoc_changed or 'c' in changed or step not in outs:
+                x = lib.cached(lib.html_to_tex, x)
+            else:
+                x = outs[step]
+        else:
+            x = getattr(lib, stage)(x)
+        if outs.get(step) != x:
+            outs[step] = x
+            changed.append(step)
+            lib.save(chapter_file(i, step, name), x)
+    return changed
+
+def typeset(outs, draft, lint=True):
+    if lint:
+        results = lib.lint_chapters([ outs[i]['e'] for i in CHAPTER_NUMS ], [ f'{i:02}_e_good.tex' for i in CHAPTER_NUMS ])
+        if any(results.values()):
+            print(lib.lint_report(results))
+        if lib.lint_errors(results):
+            raise ValueError('lint_tex found errors in the TeX, see above (to typeset anyway, add --no-lint)')
+    if draft:
+        lib.tex_to_pdf_draft([ chapter_file(i, 'e', 'good.tex') for i in CHAPTER_NUMS ], saveas='mm-draft.pdf')
+    else:
+        lib.make_final_tex([ outs[i]['e'] for i in CHAPTER_NUMS ], saveas='mm.tex')
+        lib.tex_to_pdf('mm.tex', saveas='mm.pdf', chapters=[ chapter_file(i, 'e', 'good.tex') for i in CHAPTER_NUMS ])
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-build mm.pdf whenever lib.py, header.tex, footer.tex, or a chapter changes.')
+    parser.add_argument('--draft', action='store_true',
+                        help='typeset only the chapters that changed, into mm-draft.pdf')
+    parser.add_argument('--no-lint', dest='lint', action='store_false',
+                        help="typeset even if lib.lint_tex finds errors in the chapters' TeX")
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='how often to check for changes, in seconds (default: 0.5)')
+    args = parser.parse_args()
+
+    # Start from the files we already have, so only what's out of date gets re-written.
+    outs = { i: { step: open(f).read() for step, name, _ in STEPS
+                  for f in [chapter_file(i, step, name)] if os.path.isfile(f) }
+             for i in CHAPTER_NUMS }
+    seen = {}
+    config = None
+
+    while True:
+        now = mtimes()
+        changed_files = [ f for f in now if now[f] != seen.get(f) ]
+        if not changed_files:
+            time.sleep(args.interval)
+            continue
+        time.sleep(args.interval) # editors sometimes write a file in several goes, so wait until it settles
+        if mtimes() != now:
+            continue
+        first_time = not seen
+        seen = now
+
+        t0 = time.perf_counter()
+        try:
+            if 'lib.py' in changed_files and not first_time:
+                print('watch: lib.py changed, re-loading it.')
+                importlib.reload(lib)
+            new_config = pandoc_config()
+            pandoc_changed, config = new_config != config, new_config
+
+            if first_time or 'lib.py' in changed_files:
+                todo = CHAPTER_NUMS
+            else:
+                todo = [ i for i in CHAPTER_NUMS if chapter_file(i, 'a', 'orig.html') in changed_files ]
+
+            changed = {}
+            for i in todo:
+                steps = update_chapter(i, outs[i], pandoc_changed)
+                if steps:
+                    changed[i] = steps
+            for i, steps in changed.items():
+                print(f'watch: chapter {i}: steps {", ".join(steps)} changed')
+
+            if ( any('e' in steps for steps in changed.values())
+                 or 'header.tex' in changed_files or 'footer.tex' in changed_files
+                 or (first_time and not os.path.isfile('mm-draft.pdf' if args.draft else 'mm.pdf')) ):
+                typeset(outs, args.draft, args.lint)
+                print(f'watch: re-built the PDF in {time.perf_counter() - t0:.1f} s.')
+            else:
+                print(f'watch: the PDF is already up to date ({time.perf_counter() - t0:.1f} s).')
+        except Exception:
+            traceback.print_exc()
+            print('watch: that failed; waiting for the next change.')
+            config = None # to be safe, re-run pandoc next time
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass